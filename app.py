@@ -6,24 +6,38 @@ import random
 from flask import Flask, Response
 import threading
 import requests
-import re
 import html
-import phonenumbers
-import pycountry
 import time
-import sqlite3
-from queue import Queue
 from datetime import datetime, timedelta
-from collections import deque
+from crapi import HighWaterMark, PastOtpSnapshot, SNAPSHOT_RECORDS, catch_up
+from poller import AdaptivePoller
+from dedupe import SeenStore
+from records import from_viewstats, record_id
+from storage import Database, WriteBehind, exit_on_sigterm
+from ratelimit import TelegramLimiter, limit_bot
+from shards import ShardedQueue
+from outbox import Outbox
+from botapi import BotApi
+from subscribers import SubscriberIndex
+from countries import resolver as country_resolver
 
 # ==================== CONFIG ====================
 BOT_TOKEN = os.getenv("BOT_TOKEN") 
 ADMIN_ID = 6102951142
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+telegram_limiter = TelegramLimiter()
+limit_bot(bot, telegram_limiter)
 
 DATA_FILE = "bot_data.json"
 NUMBERS_DIR = "numbers"
 DB_FILE = "bot_database.db"
+db = Database(DB_FILE)
+db_writer = WriteBehind(db)  # Batched stats/cache writes, off the delivery path
+HWM_FILE = "viewstats_hwm.json"
+SEEN_FILE = "seen_messages.bin"
+POLL_RECORDS = 10
+BACKFILL_INTERVAL = 600  # Refill past_otps_cache from the panel every 10 min
+PAST_OTP_RETENTION = 7 * 86400  # past_otps_cache keeps records whose panel timestamp is newer than this
 os.makedirs(NUMBERS_DIR, exist_ok=True)
 
 # API Config
@@ -34,19 +48,22 @@ CHANNEL_LINK = "https://t.me/NomorGoBot"
 BACKUP = "https://t.me/NomorGo"
 
 # ==================== QUEUES ====================
-group_queue = Queue(maxsize=1000)
-personal_queue = Queue(maxsize=5000)
-seen_messages = deque(maxlen=50000)  # Auto-cleanup old messages
-
-# ==================== REGEX PATTERNS (PRE-COMPILED) ====================
-KEYWORD_REGEX = re.compile(r"(otp|code|pin|password|verify)[^\d]{0,10}(\d[\d\-]{3,8})", re.I)
-REVERSE_REGEX = re.compile(r"(\d[\d\-]{3,8})[^\w]{0,10}(otp|code|pin|password|verify)", re.I)
-GENERIC_REGEX = re.compile(r"\d{2,4}[-]?\d{2,4}")
-UNICODE_CLEAN = re.compile(r"[\u200f\u200e\u202a-\u202e]")
+outbox = Outbox(db)  # Outbound messages stay on disk until Telegram accepts them
+OUTBOX_BATCH = 20
+GROUP_TTL = 180  # Seconds after fetch before a group post is shed; the code has likely expired
+PERSONAL_TTL = 600  # DMs are kept longer: the user is waiting for this number's code
+GROUP_BACKLOG = 20  # Waiting posts per group (about a minute of its 20/min budget); older ones are shed
+group_queue = outbox.lane("group")
+PERSONAL_SHARDS = 16  # DM workers; a chat always maps to the same one, so its OTPs stay in order
+personal_queue = ShardedQueue(PERSONAL_SHARDS, factory=lambda shard: outbox.lane(f"dm{shard}"))
+telegram_api = BotApi(BOT_TOKEN, pool_size=PERSONAL_SHARDS + 1)  # DM shards + group sender
+seen_messages = SeenStore(SEEN_FILE, ttl=86400)  # Delivered message ids, persisted
+viewstats_mark = HighWaterMark(HWM_FILE)  # Incremental viewstats polling
+viewstats_poller = AdaptivePoller(min_interval=0.3, max_interval=5)
 
 # ==================== DATABASE SETUP ====================
 def init_db():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     
     # User numbers mapping
@@ -58,10 +75,6 @@ def init_db():
                  (chat_id INTEGER PRIMARY KEY, total_otps INTEGER DEFAULT 0, 
                   last_otp REAL, joined_at REAL)''')
     
-    # Message cache (24hr TTL)
-    c.execute('''CREATE TABLE IF NOT EXISTS message_cache
-                 (msg_id TEXT PRIMARY KEY, created_at REAL)''')
-    
     # Past OTPs cache for faster access
     c.execute('''CREATE TABLE IF NOT EXISTS past_otps_cache
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -70,12 +83,26 @@ def init_db():
                   message TEXT,
                   otp TEXT,
                   timestamp TEXT,
-                  received_at REAL)''')
+                  received_at REAL,
+                  record_id INTEGER)''')
     
     # Create index for faster queries
     c.execute('''CREATE INDEX IF NOT EXISTS idx_number ON past_otps_cache(number)''')
     c.execute('''CREATE INDEX IF NOT EXISTS idx_received_at ON past_otps_cache(received_at)''')
     
+    # One row per panel record (records.record_id), so the backfill can re-insert freely
+    columns = {row[1] for row in c.execute("PRAGMA table_info(past_otps_cache)")}
+    if "record_id" not in columns:
+        c.execute("ALTER TABLE past_otps_cache ADD COLUMN record_id INTEGER")
+    c.execute("SELECT id, number, timestamp, message FROM past_otps_cache WHERE record_id IS NULL")
+    c.executemany("UPDATE past_otps_cache SET record_id = ? WHERE id = ?",
+                  [(record_id(number, dt, message), row_id) for row_id, number, dt, message in c.fetchall()])
+    c.execute('''DELETE FROM past_otps_cache WHERE id NOT IN
+                 (SELECT MIN(id) FROM past_otps_cache GROUP BY record_id)''')
+    c.execute("DROP INDEX IF EXISTS idx_past_record")
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_past_record_id
+                 ON past_otps_cache(record_id)''')
+    
     conn.commit()
     conn.close()
 
@@ -115,17 +142,21 @@ def save_data():
 load_data()
 
 # ==================== DATABASE HELPERS ====================
-def get_chat_by_number(number):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+subscribers = SubscriberIndex()  # number -> chat_ids, mirrors user_numbers
+
+def load_subscribers():
+    conn = db.connect()
     c = conn.cursor()
-    c.execute("SELECT chat_id FROM user_numbers WHERE number=?", (number,))
-    result = c.fetchone()
+    c.execute("SELECT number, chat_id FROM user_numbers")
+    subscribers.load(c.fetchall())
     conn.close()
-    return result[0] if result else None
+
+def get_chat_by_number(number):
+    return next(iter(subscribers.chats_for(number)), None)
 
 def get_number_by_chat(chat_id):
     """Get currently assigned number for a user"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("SELECT number FROM user_numbers WHERE chat_id=? ORDER BY assigned_at DESC LIMIT 1", (chat_id,))
     result = c.fetchone()
@@ -133,67 +164,93 @@ def get_number_by_chat(chat_id):
     return result[0] if result else None
 
 def assign_number(number, chat_id, country):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("INSERT OR REPLACE INTO user_numbers VALUES (?, ?, ?, ?)",
               (number, chat_id, country, time.time()))
     conn.commit()
     conn.close()
+    subscribers.assign(number, chat_id)
+
+load_subscribers()
 
 def increment_user_stats(chat_id):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("""INSERT INTO user_stats (chat_id, total_otps, last_otp, joined_at) 
-                 VALUES (?, 1, ?, ?) 
-                 ON CONFLICT(chat_id) DO UPDATE SET 
-                 total_otps = total_otps + 1, last_otp = ?""",
-              (chat_id, time.time(), time.time(), time.time()))
-    conn.commit()
-    conn.close()
+    now = time.time()
+    db_writer.submit("""INSERT INTO user_stats (chat_id, total_otps, last_otp, joined_at) 
+                        VALUES (?, 1, ?, ?) 
+                        ON CONFLICT(chat_id) DO UPDATE SET 
+                        total_otps = total_otps + 1, last_otp = ?""",
+                     (chat_id, now, now, now))
 
-def cache_past_otp(number, sender, message, otp, timestamp):
+def cache_past_otp(record):
     """Cache OTP in database for faster retrieval"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    c = conn.cursor()
-    try:
-        c.execute("""INSERT INTO past_otps_cache 
-                     (number, sender, message, otp, timestamp, received_at)
-                     VALUES (?, ?, ?, ?, ?, ?)""",
-                  (number, sender, message, otp, timestamp, time.time()))
-        conn.commit()
-    except:
-        pass  # Ignore duplicates
-    conn.close()
+    db_writer.submit("""INSERT OR IGNORE INTO past_otps_cache 
+                        (number, sender, message, otp, timestamp, received_at, record_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                     (record.normalized, record.sender, record.message, record.otp, record.dt, time.time(),
+                      record.id))
 
 def get_cached_past_otps(number, limit=50):
     """Get cached past OTPs from database"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("""SELECT sender, message, otp, timestamp 
                  FROM past_otps_cache 
                  WHERE number=? 
-                 ORDER BY received_at DESC 
+                 ORDER BY timestamp DESC 
                  LIMIT ?""", (number, limit))
     results = c.fetchall()
     conn.close()
     return results
 
+def get_past_otp_summary(number):
+    """(messages, distinct senders, messages with an OTP) cached for a number"""
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute("""SELECT COUNT(*), COUNT(DISTINCT sender), COUNT(otp)
+                 FROM past_otps_cache 
+                 WHERE number=?""", (number,))
+    result = c.fetchone()
+    conn.close()
+    return result
+
+def past_cache_cutoff():
+    """Oldest panel timestamp past_otps_cache keeps ("YYYY-MM-DD HH:MM:SS", compares as text)"""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - PAST_OTP_RETENTION))
+
+def cache_past_records(records):
+    """Bulk-insert raw viewstats rows into past_otps_cache, returns rows added"""
+    now = time.time()
+    cutoff = past_cache_cutoff()
+    # Rows already past retention would only be deleted again by clean_old_cache
+    rows = [
+        (rec.normalized, rec.sender, rec.message, rec.otp, rec.dt, now, rec.id)
+        for rec in map(from_viewstats, records)
+        if rec.dt >= cutoff
+    ]
+    conn = db.connect()
+    c = conn.cursor()
+    before = conn.total_changes
+    c.executemany("""INSERT OR IGNORE INTO past_otps_cache 
+                     (number, sender, message, otp, timestamp, received_at, record_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+    added = conn.total_changes - before
+    conn.commit()
+    conn.close()
+    return added
+
 def is_message_seen(msg_id):
-    if msg_id in seen_messages:
-        return True
-    seen_messages.append(msg_id)
-    return False
+    return msg_id in seen_messages
+
+def mark_message_seen(msg_id):
+    seen_messages.add(msg_id)
 
 def clean_old_cache():
-    """Remove messages older than 24 hours from DB"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    """Remove past OTPs older than 7 days from DB"""
+    conn = db.connect()
     c = conn.cursor()
-    cutoff = time.time() - 86400  # 24 hours
-    c.execute("DELETE FROM message_cache WHERE created_at < ?", (cutoff,))
-    
-    # Also clean old past OTPs (keep only last 7 days)
-    otp_cutoff = time.time() - (7 * 86400)
-    c.execute("DELETE FROM past_otps_cache WHERE received_at < ?", (otp_cutoff,))
+    # By the record's own timestamp: the backfill re-inserts rows with a fresh received_at
+    c.execute("DELETE FROM past_otps_cache WHERE timestamp < ?", (past_cache_cutoff(),))
     
     conn.commit()
     conn.close()
@@ -207,26 +264,15 @@ def index():
 
 @app.route("/health")
 def health():
-    return Response(f"OK - Queue: G={group_queue.qsize()} P={personal_queue.qsize()}", status=200)
-
-# ==================== OTP EXTRACTION ====================
-def extract_otp(message: str) -> str | None:
-    message = UNICODE_CLEAN.sub("", message)
-    
-    match = KEYWORD_REGEX.search(message)
-    if match:
-        return re.sub(r"\D", "", match.group(2))
-    
-    match = REVERSE_REGEX.search(message)
-    if match:
-        return re.sub(r"\D", "", match.group(1))
-    
-    match = GENERIC_REGEX.findall(message)
-    if match:
-        return re.sub(r"\D", "", match[0])
-    
-    return None
+    healthy = db_writer.alive()
+    return Response(
+        f"{'OK' if healthy else 'DEGRADED'} - Queue: G={group_queue.qsize()} P={personal_queue.qsize()} "
+        f"GapRecovered={viewstats_mark.gap_recovered} {viewstats_poller.status()} "
+        f"{db_writer.status()} {telegram_limiter.status()} {outbox.status()}",
+        status=200 if healthy else 503
+    )
 
+# ==================== HELPER FUNCTIONS ====================
 def mask_number(number: str) -> str:
     """Mask the middle 2 digits of a phone number, showing first 6 and last 4 digits."""
     number = number.strip()
@@ -235,29 +281,15 @@ def mask_number(number: str) -> str:
     return number[:6] + "**" + number[-4:]
 
 def country_from_number(number: str) -> tuple[str, str]:
-    try:
-        parsed = phonenumbers.parse("+" + number)
-        region = phonenumbers.region_code_for_number(parsed)
-        if not region:
-            return "Unknown", "🌍"
-        country_obj = pycountry.countries.get(alpha_2=region)
-        if not country_obj:
-            return "Unknown", "🌍"
-        flag = "".join([chr(127397 + ord(c)) for c in region])
-        return country_obj.name, flag
-    except:
-        return "Unknown", "🌍"
+    name, _, flag = country_resolver.resolve(number)
+    return name, flag
 
 # ==================== MESSAGE FORMATTERS ====================
 def format_group_message(record):
     """Format message for public group"""
-    number = record.get("num") or "Unknown"
-    sender = record.get("cli") or "Unknown"
-    message = record.get("message") or ""
-    dt = record.get("dt") or ""
-    
-    country, flag = country_from_number(number)
-    otp = extract_otp(message)
+    number = record.number or "Unknown"
+    sender, message, dt = record.sender, record.message, record.dt
+    country, flag, otp = record.country, record.flag, record.otp
     otp_line = f"<blockquote> <b>OTP:</b> <code>{html.escape(otp)}</code></blockquote>\n" if otp else ""
     
     formatted = (
@@ -281,11 +313,8 @@ def format_group_message(record):
 
 def format_personal_message(record):
     """Format message for personal DM"""
-    number = record.get("num") or "Unknown"
-    sender = record.get("cli") or "Unknown"
-    message = record.get("message") or ""
-    
-    otp = extract_otp(message)
+    number = record.number or "Unknown"
+    sender, message, otp = record.sender, record.message, record.otp
     otp_display = f"<b>🎯 OTP:</b> <code>{html.escape(otp)}</code>\n\n" if otp else ""
     
     formatted = (
@@ -300,20 +329,53 @@ def format_personal_message(record):
     return formatted
 
 # ==================== THREAD 1: OTP SCRAPER ====================
+def fetch_viewstats_page(records):
+    """Fetch the newest `records` rows past the high-water mark (None on failure)"""
+    try:
+        response = requests.get(
+            f"{BASE_URL}/viewstats",
+            params=viewstats_mark.params(API_TOKEN, records),
+            timeout=15
+        )
+        stats = response.json()
+    except Exception as e:
+        print(f"⚠️ Catch-up fetch failed: {e}", flush=True)
+        return None
+    if stats.get("status") != "success":
+        return None
+    return stats.get("data", [])
+
+def fetch_past_snapshot():
+    """Fetch the newest SNAPSHOT_RECORDS rows for "View Old OTPs" (None on failure)"""
+    response = requests.get(
+        f"{BASE_URL}/viewstats",
+        params={
+            "token": API_TOKEN,
+            "dt1": "1970-01-01 00:00:00",
+            "dt2": "2099-12-31 23:59:59",
+            "records": SNAPSHOT_RECORDS
+        },
+        timeout=15
+    )
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    if data.get("status") != "success":
+        return None
+    return data.get("data", [])
+
+past_otp_snapshot = PastOtpSnapshot(fetch_past_snapshot, poller=viewstats_poller)
+
 def otp_scraper_thread():
     """Continuously fetch OTPs and push to queues"""
     print("🟢 OTP Scraper Started", flush=True)
     
     while True:
+        viewstats_poller.wait()
         try:
             response = requests.get(
                 f"{BASE_URL}/viewstats",
-                params={
-                    "token": API_TOKEN,
-                    "dt1": "1970-01-01 00:00:00",
-                    "dt2": "2099-12-31 23:59:59",
-                    "records": 10
-                },
+                params=viewstats_mark.params(API_TOKEN, POLL_RECORDS),
                 timeout=8
             )
             
@@ -321,123 +383,160 @@ def otp_scraper_thread():
                 stats = response.json()
                 
                 if stats.get("status") == "success":
-                    for record in stats["data"]:
-                        msg_id = f"{record.get('dt')}_{record.get('num')}_{record.get('message')[:50]}"
+                    rows = catch_up(viewstats_mark, fetch_viewstats_page, stats["data"], POLL_RECORDS,
+                                    poller=viewstats_poller)
+                    new_records = viewstats_mark.new_rows(rows)
+                    for row in new_records:
+                        record = from_viewstats(row)
                         
-                        if is_message_seen(msg_id):
+                        if is_message_seen(record.id):
                             continue
                         
-                        number = str(record.get("num", "")).lstrip("0").lstrip("+")
-                        sender = record.get("cli", "Unknown")
-                        message = record.get("message", "")
-                        timestamp = record.get("dt", "")
-                        otp = extract_otp(message)
+                        number = record.normalized
                         
                         # Cache this OTP
-                        cache_past_otp(number, sender, message, otp, timestamp)
+                        cache_past_otp(record)
                         
                         # Push to group queue
-                        try:
-                            group_queue.put_nowait((record, time.time()))
-                            print(f"📤 Queued for group: {number}", flush=True)
-                        except:
-                            print("⚠️ Group queue full!", flush=True)
+                        queue_group_message(record)
+                        print(f"📤 Queued for group: {number}", flush=True)
                         
                         # Check if user has this number
                         chat_id = get_chat_by_number(number)
                         if chat_id:
-                            try:
-                                personal_queue.put_nowait((record, chat_id, time.time()))
-                                print(f"📤 Queued for user {chat_id}: {number}", flush=True)
-                            except:
-                                print(f"⚠️ Personal queue full for {chat_id}!", flush=True)
-            
-            time.sleep(0.3)  # Poll every 300ms
+                            queue_personal_message(record, chat_id)
+                            print(f"📤 Queued for user {chat_id}: {number}", flush=True)
+                        
+                        # Seen only once its messages are in the outbox; a failed write is retried next poll
+                        mark_message_seen(record.id)
+                    
+                    viewstats_mark.advance(new_records)
+                    viewstats_mark.save()
+                    seen_messages.maybe_save()
+                    viewstats_poller.record(len(new_records))
+                else:
+                    viewstats_poller.record_error()
+            else:
+                viewstats_poller.record_error()
             
         except Exception as e:
             print(f"❌ Scraper error: {e}", flush=True)
-            time.sleep(2)
+            viewstats_poller.record_error()
 
 # ==================== THREAD 2: GROUP SENDER ====================
+def queue_group_message(record):
+    """Persist the group post for every OTP group"""
+    msg, kb = format_group_message(record)
+    fetch_time = time.time()
+    for group_id in [OTP_GROUP_ID]:
+        group_queue.put(group_id, {
+            "chat_id": group_id,
+            "text": msg[:4000],
+            "parse_mode": "HTML",
+            "reply_markup": kb.to_json()
+        }, deadline=fetch_time + GROUP_TTL, fetch_time=fetch_time)
+
 def group_sender_thread():
     """Send messages to public group"""
     print("🟢 Group Sender Started", flush=True)
     
     while True:
+        done = []
         try:
-            record, fetch_time = group_queue.get()
-            
-            msg, kb = format_group_message(record)
-            
-            payload = {
-                "chat_id": OTP_GROUP_ID,
-                "text": msg[:4000],
-                "parse_mode": "HTML",
-                "reply_markup": kb.to_json()
-            }
-            
-            response = requests.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                json=payload,
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                delay = time.time() - fetch_time
-                print(f"✅ Group sent (delay: {delay:.2f}s)", flush=True)
-            elif response.status_code == 429:
-                retry_after = response.json().get("parameters", {}).get("retry_after", 2)
-                print(f"⏳ Rate limited, waiting {retry_after}s", flush=True)
-                time.sleep(retry_after)
-                group_queue.put((record, fetch_time))  # Re-queue
-            else:
-                print(f"❌ Group send failed: {response.status_code}", flush=True)
-            
-            time.sleep(0.5)  # 500ms between group messages
-            
+            # Under load, the oldest posts go first; DMs are never trimmed
+            group_queue.shed_backlog(GROUP_BACKLOG)
+            for item in group_queue.claim(OUTBOX_BATCH):
+                if item.expired():
+                    group_queue.drop([item.id], "expired")
+                    continue
+                telegram_limiter.acquire(item.chat_id)
+                try:
+                    response = telegram_api.send_message(item.payload)
+                except requests.RequestException as e:
+                    print(f"❌ Group send error: {e}", flush=True)
+                    group_queue.retry([item.id])
+                    continue
+                
+                if response.status_code == 200:
+                    done.append(item.id)
+                    delay = time.time() - item.meta["fetch_time"]
+                    print(f"✅ Group sent (delay: {delay:.2f}s)", flush=True)
+                elif response.status_code == 429:
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 2)
+                    print(f"⏳ Rate limited, backing off {retry_after}s", flush=True)
+                    telegram_limiter.backoff(item.chat_id, retry_after)
+                    group_queue.retry([item.id], delay=retry_after)
+                elif response.status_code >= 500:
+                    print(f"❌ Group send failed: {response.status_code}, will retry", flush=True)
+                    group_queue.retry([item.id])
+                else:
+                    # Telegram rejected the message itself; resending will not help
+                    print(f"❌ Group send failed: {response.status_code}", flush=True)
+                    done.append(item.id)
+
         except Exception as e:
             print(f"❌ Group sender error: {e}", flush=True)
             time.sleep(1)
+        finally:
+            group_queue.ack(done)
 
 # ==================== THREAD 3: PERSONAL DM SENDER ====================
-def personal_sender_thread():
-    """Send messages to individual users"""
-    print("🟢 Personal Sender Started", flush=True)
+def queue_personal_message(record, chat_id):
+    """Persist a DM on the chat's shard"""
+    fetch_time = time.time()
+    personal_queue.shard_for(chat_id).put(chat_id, {
+        "chat_id": chat_id,
+        "text": format_personal_message(record)[:4000],
+        "parse_mode": "HTML"
+    }, deadline=fetch_time + PERSONAL_TTL, fetch_time=fetch_time)
+
+def personal_sender_thread(queue):
+    """Send one shard's DMs in order; other shards run in parallel"""
+    print(f"🟢 Personal Sender {threading.current_thread().name} Started", flush=True)
     
     while True:
+        done = []
         try:
-            record, chat_id, fetch_time = personal_queue.get()
-            
-            msg = format_personal_message(record)
-            
-            payload = {
-                "chat_id": chat_id,
-                "text": msg[:4000],
-                "parse_mode": "HTML"
-            }
-            
-            response = requests.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                json=payload,
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                increment_user_stats(chat_id)
-                delay = time.time() - fetch_time
-                print(f"✅ DM sent to {chat_id} (delay: {delay:.2f}s)", flush=True)
-            elif response.status_code == 429:
-                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
-                time.sleep(retry_after)
-                personal_queue.put((record, chat_id, fetch_time))  # Re-queue
-            else:
-                print(f"❌ DM failed for {chat_id}: {response.status_code}", flush=True)
-            
-            time.sleep(0.2)  # 200ms between personal messages (faster)
-            
+            items = queue.claim(OUTBOX_BATCH)
+            for index, item in enumerate(items):
+                chat_id = item.chat_id
+                if item.expired():
+                    queue.drop([item.id], "expired")
+                    continue
+                
+                # Retry a 429 in place rather than re-queueing, so this chat's
+                # later OTPs cannot overtake it
+                while True:
+                    telegram_limiter.acquire(chat_id)
+                    try:
+                        response = telegram_api.send_message(item.payload)
+                    except requests.RequestException as e:
+                        print(f"❌ DM error for {chat_id}: {e}", flush=True)
+                        response = None
+                        break
+                    if response.status_code != 429:
+                        break
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                    print(f"⏳ DM to {chat_id} rate limited, backing off {retry_after}s", flush=True)
+                    telegram_limiter.backoff(chat_id, retry_after)
+                
+                if response is None or response.status_code >= 500:
+                    # Put this DM and everything behind it back, in order
+                    queue.retry([later.id for later in items[index:]])
+                    break
+                done.append(item.id)
+                if response.status_code == 200:
+                    increment_user_stats(chat_id)
+                    delay = time.time() - item.meta["fetch_time"]
+                    print(f"✅ DM sent to {chat_id} (delay: {delay:.2f}s)", flush=True)
+                else:
+                    print(f"❌ DM failed for {chat_id}: {response.status_code}", flush=True)
+
         except Exception as e:
             print(f"❌ Personal sender error: {e}", flush=True)
             time.sleep(1)
+        finally:
+            queue.ack(done)
 
 # ==================== ADMIN COMMANDS ====================
 @bot.message_handler(content_types=["document"])
@@ -537,7 +636,7 @@ def bot_stats(message):
         return
     
     # Get cache size
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("SELECT COUNT(*) FROM past_otps_cache")
     cache_count = c.fetchone()[0]
@@ -550,6 +649,7 @@ def bot_stats(message):
 📥 Group Queue: {group_queue.qsize()}
 📨 Personal Queue: {personal_queue.qsize()}
 💾 Cached Messages: {len(seen_messages)}
+🩹 Gap-Recovered Records: {viewstats_mark.gap_recovered}
 💿 Past OTPs Cache: {cache_count}
 🌍 Countries: {len(numbers_by_country)}
 📞 Total Numbers: {sum(len(v) for v in numbers_by_country.values())}
@@ -571,7 +671,6 @@ def broadcast_message(message):
         try:
             bot.send_message(user_id, f"📢 <b>Broadcast:</b>\n\n{text}")
             success += 1
-            time.sleep(0.05)
         except:
             fail += 1
     
@@ -582,7 +681,7 @@ def clear_cache(message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("DELETE FROM past_otps_cache")
     deleted = c.rowcount
@@ -647,7 +746,7 @@ def start(message):
 def my_stats(message):
     chat_id = message.chat.id
     
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("SELECT total_otps, last_otp FROM user_stats WHERE chat_id=?", (chat_id,))
     result = c.fetchone()
@@ -750,125 +849,73 @@ def send_random_number(chat_id, country=None, edit=False):
         msg = bot.send_message(chat_id, text, reply_markup=markup)
         user_messages[chat_id] = msg
 
-def fetch_past_otps(chat_id, number):
-    """Fetch and display past OTPs for a number from API (last 2000 SMS)"""
-    
-    # Rate limiting - 30 seconds cooldown
-    now = time.time()
-    if chat_id in past_otp_fetch_cooldown:
-        time_passed = now - past_otp_fetch_cooldown[chat_id]
-        if time_passed < 3:
-            wait_time = int(3 - time_passed)
-            bot.send_message(chat_id, f"⏳ Please wait {wait_time}s before fetching past OTPs again.")
-            return
-    
-    past_otp_fetch_cooldown[chat_id] = now
+def fetch_past_otps(chat_id, number, refresh=False):
+    """Show past OTPs for a number from the local history (panel only on refresh)"""
+    if refresh:
+        now = time.time()
+        if chat_id in past_otp_fetch_cooldown:
+            time_passed = now - past_otp_fetch_cooldown[chat_id]
+            if time_passed < 3:
+                wait_time = int(3 - time_passed)
+                bot.send_message(chat_id, f"⏳ Please wait {wait_time}s before refreshing past OTPs again.")
+                return
+        past_otp_fetch_cooldown[chat_id] = now
     
     try:
-        # Show loading message
-        loading_msg = bot.send_message(chat_id, "⏳ <b>Fetching past OTPs...</b>\n\nThis may take a few seconds.")
+        if refresh:
+            loading_msg = bot.send_message(chat_id, "⏳ <b>Refreshing past OTPs from panel...</b>\n\nThis may take a few seconds.")
+            records = past_otp_snapshot.lookup(number)
+            bot.delete_message(chat_id, loading_msg.message_id)
+            if records is None:
+                bot.send_message(chat_id, "❌ Failed to fetch past OTPs. Try again later.")
+                return
+            cache_past_records(records)
         
-        # First try to get from cache
         cached_otps = get_cached_past_otps(number, 50)
+        total, senders, otp_count = get_past_otp_summary(number)
         
-        # Also fetch fresh data from API
-        response = requests.get(
-            f"{BASE_URL}/viewstats",
-            params={
-                "token": API_TOKEN,
-                "dt1": "1970-01-01 00:00:00",
-                "dt2": "2099-12-31 23:59:59",
-                "records": 2000
-            },
-            timeout=15
-        )
-        
-        bot.delete_message(chat_id, loading_msg.message_id)
-        
-        if response.status_code != 200:
-            bot.send_message(chat_id, "❌ Failed to fetch past OTPs. Try again later.")
-            return
-        
-        data = response.json()
-        
-        if data.get("status") != "success":
-            bot.send_message(chat_id, "❌ No past OTPs found in API response.")
-            return
-        
-        # Filter messages for this specific number
-        user_messages_list = []
-        for record in data.get("data", []):
-            record_number = str(record.get("num", "")).lstrip("0").lstrip("+")
-            if record_number == number:
-                user_messages_list.append(record)
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🔄 Refresh from panel", callback_data=f"refresh_past_{number}"))
         
-        if not user_messages_list and not cached_otps:
-            bot.send_message(chat_id, f"📭 <b>No past OTPs found for:</b>\n<code>{number}</code>")
+        if not cached_otps:
+            bot.send_message(chat_id, f"📭 <b>No past OTPs found for:</b>\n<code>{number}</code>",
+                             reply_markup=markup)
             return
         
-        # Format the message
         country_info, flag = country_from_number(number)
         
         msg_text = f"{flag} <b>Past OTPs for {number}</b>\n"
         msg_text += f"<b>Country:</b> {country_info}\n"
-        msg_text += f"<b>Total Messages Found:</b> {len(user_messages_list)}\n"
+        msg_text += f"<b>Total Messages Found:</b> {total}\n"
         msg_text += "━━━━━━━━━━━━━━━━━━\n\n"
         
-        # Display messages (limit to last 50)
-        display_count = min(50, len(user_messages_list))
-        
-        if display_count == 0 and cached_otps:
-            msg_text += "<i>📦 Showing cached data:</i>\n\n"
-            for i, (sender, message, otp, timestamp) in enumerate(cached_otps[:30], 1):
-                otp_display = f"🎯 <code>{html.escape(otp)}</code>" if otp else "❌ No OTP"
-                
-                msg_text += f"<b>{i}. {html.escape(sender)}</b>\n"
-                msg_text += f"   {otp_display}\n"
-                msg_text += f"   🕐 {html.escape(timestamp)}\n"
-                msg_text += f"   📩 {html.escape(message[:80])}\n\n"
-                
-                if len(msg_text) > 3500:
-                    bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
-                    msg_text = ""
-        else:
-            for i, record in enumerate(user_messages_list[:display_count], 1):
-                sender = record.get("cli", "Unknown")
-                message = record.get("message", "")
-                dt = record.get("dt", "")
-                
-                otp = extract_otp(message)
-                otp_display = f"🎯 <code>{html.escape(otp)}</code>" if otp else "❌ No OTP"
-                
-                msg_text += f"<b>{i}. {html.escape(sender)}</b>\n"
-                msg_text += f"   {otp_display}\n"
-                msg_text += f"   🕐 {html.escape(str(dt))}\n"
-                msg_text += f"   📩 {html.escape(message[:100])}\n\n"
-                
-                # Split message if too long (Telegram limit ~4096 chars)
-                if len(msg_text) > 3500:
-                    bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
-                    msg_text = ""
+        for i, (sender, message, otp, timestamp) in enumerate(cached_otps, 1):
+            otp_display = f"🎯 <code>{html.escape(otp)}</code>" if otp else "❌ No OTP"
+            
+            msg_text += f"<b>{i}. {html.escape(sender or 'Unknown')}</b>\n"
+            msg_text += f"   {otp_display}\n"
+            msg_text += f"   🕐 {html.escape(str(timestamp))}\n"
+            msg_text += f"   📩 {html.escape((message or '')[:100])}\n\n"
+            
+            # Split message if too long (Telegram limit ~4096 chars)
+            if len(msg_text) > 3500:
+                bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
+                msg_text = ""
         
         if msg_text:
-            if len(user_messages_list) > display_count:
-                msg_text += f"\n<i>Showing {display_count} of {len(user_messages_list)} messages</i>"
+            if total > len(cached_otps):
+                msg_text += f"\n<i>Showing {len(cached_otps)} of {total} messages</i>"
             bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
         
-        # Send summary message
         summary = f"""
 📊 <b>Summary:</b>
 
-✅ Found {len(user_messages_list)} messages
-📱 Service providers: {len(set(r.get('cli', 'Unknown') for r in user_messages_list))}
-🔑 OTPs extracted: {sum(1 for r in user_messages_list if extract_otp(r.get('message', '')))}
+✅ Found {total} messages
+📱 Service providers: {senders}
+🔑 OTPs extracted: {otp_count}
 """
-        bot.send_message(chat_id, summary)
+        bot.send_message(chat_id, summary, reply_markup=markup)
         
-    except requests.Timeout:
-        bot.send_message(chat_id, "❌ Request timeout. API is taking too long. Try again later.")
-    except requests.RequestException as e:
-        print(f"❌ Error fetching past OTPs: {e}", flush=True)
-        bot.send_message(chat_id, "❌ Network error. Please try again later.")
     except Exception as e:
         print(f"❌ Error fetching past OTPs: {e}", flush=True)
         bot.send_message(chat_id, "❌ Error fetching past OTPs. Please try again later.")
@@ -915,6 +962,16 @@ def handle_callbacks(call):
         bot.answer_callback_query(call.id, "⏳ Fetching past OTPs...")
         fetch_past_otps(chat_id, number)
     
+    elif call.data.startswith("refresh_past_"):
+        number = call.data[13:]
+        assigned_number = get_number_by_chat(chat_id)
+        if assigned_number != number:
+            bot.answer_callback_query(call.id, "❌ This is not your current number!")
+            return
+        
+        bot.answer_callback_query(call.id, "⏳ Refreshing from panel...")
+        fetch_past_otps(chat_id, number, refresh=True)
+    
     elif call.data == "verify_join":
         # Re-check membership
         not_joined = []
@@ -983,6 +1040,23 @@ def other_admin_commands(message):
         else:
             bot.reply_to(message, "Usage: /cleannumbers <name>")
 
+# ==================== HISTORY BACKFILL ====================
+def past_otp_backfill_thread():
+    """Keep past_otps_cache filled from the panel so lookups stay local"""
+    while True:
+        try:
+            viewstats_poller.throttle()  # a 2,000-row snapshot counts against the panel's rate cap
+            records = fetch_past_snapshot()
+            if records is None:
+                viewstats_poller.record_error()
+            if records:
+                added = cache_past_records(records)
+                if added:
+                    print(f"📚 Backfilled {added} past OTPs", flush=True)
+        except Exception as e:
+            print(f"❌ Backfill error: {e}", flush=True)
+        time.sleep(BACKFILL_INTERVAL)
+
 # ==================== CLEANUP THREAD ====================
 def cleanup_thread():
     """Clean old cache every hour"""
@@ -1011,11 +1085,16 @@ if __name__ == "__main__":
     print(f"📊 Initial stats: {len(numbers_by_country)} countries loaded", flush=True)
     
     # Start all threads
+    exit_on_sigterm()
+    db_writer.start()
+    outbox.replay()
     threading.Thread(target=run_bot, daemon=True, name="BotPoller").start()
     threading.Thread(target=otp_scraper_thread, daemon=True, name="OTPScraper").start()
     threading.Thread(target=group_sender_thread, daemon=True, name="GroupSender").start()
-    threading.Thread(target=personal_sender_thread, daemon=True, name="PersonalSender").start()
+    threading.Thread(target=telegram_api.warm, daemon=True, name="ApiWarmup").start()
+    personal_queue.start(personal_sender_thread, name="PersonalSender")
     threading.Thread(target=cleanup_thread, daemon=True, name="Cleaner").start()
+    threading.Thread(target=past_otp_backfill_thread, daemon=True, name="Backfill").start()
     
     print("✅ All threads started successfully!", flush=True)
     
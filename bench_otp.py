@@ -0,0 +1,68 @@
+"""Speed and accuracy report for otp.extract_otp.
+
+    python bench_otp.py [corpus.jsonl] [--rounds N] [--misses]
+
+Each corpus line is ``{"message": ..., "otp": "123456" | null}``.  A wrong
+code counts as both a false positive and a false negative.
+"""
+import argparse
+import json
+import time
+
+from otp import extract_otp
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def score(corpus):
+    tp = fp = fn = 0
+    misses = []
+    for case in corpus:
+        expected, got = case["otp"], extract_otp(case["message"])
+        if got == expected:
+            tp += expected is not None
+            continue
+        fp += got is not None
+        fn += expected is not None
+        misses.append((expected, got, case["message"]))
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    return precision, recall, misses
+
+
+def throughput(corpus, rounds):
+    messages = [case["message"] for case in corpus]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            extract_otp(message)
+    elapsed = time.perf_counter() - start
+    return len(messages) * rounds / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", nargs="?", default="otp_corpus.jsonl")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--misses", action="store_true", help="list every wrong answer")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    precision, recall, misses = score(corpus)
+    rate = throughput(corpus, args.rounds)
+
+    print(f"Corpus:     {len(corpus)} messages ({args.corpus})")
+    print(f"Throughput: {rate:,.0f} msg/s over {args.rounds} rounds")
+    print(f"Precision:  {precision:.3f}")
+    print(f"Recall:     {recall:.3f}")
+    print(f"Wrong:      {len(misses)}")
+    if args.misses:
+        for expected, got, message in misses:
+            print(f"  expected={expected!r} got={got!r}  {message[:70]!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Keep-alive client for the Telegram Bot API.
+
+The crapi bots' senders called a bare ``requests.post`` for every message,
+and each call paid for a fresh TCP + TLS handshake with api.telegram.org.
+The DataTables bots posted through the panel scraper's ``Session``, whose
+default pool keeps 10 connections per host, so the parallel senders kept
+opening and throwing away sockets.  ``BotApi`` owns its own ``Session``
+whose pool is sized to the sender concurrency.  Timeouts and retries are
+set once, and ``warm`` opens the connections at startup.
+
+Only failures where Telegram never handled the request are retried:
+connect errors and 503 from its front end.  A read timeout, a 502 or a 504
+may come after the message was already delivered, so those are not
+retried here (the outbox retries them later).  429s are left to
+``TelegramLimiter``.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_URL = "https://api.telegram.org"
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 8
+
+
+class BotApi:
+    """Pooled, keep-alive ``requests`` session bound to one bot token."""
+
+    def __init__(self, token, pool_size=16, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=2):
+        self.base = f"{API_URL}/bot{token}"
+        self.pool_size = pool_size
+        self.timeout = timeout
+        retry = Retry(
+            total=retries, connect=retries, read=0, status=retries,
+            status_forcelist=(503,), allowed_methods=None,
+            backoff_factor=0.3, raise_on_status=False, respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount(API_URL, adapter)
+
+    def post(self, method, timeout=None, **kwargs):
+        """POST ``method`` (e.g. "sendMessage"); ``kwargs`` go to ``Session.post``."""
+        return self.session.post(f"{self.base}/{method}", timeout=timeout or self.timeout, **kwargs)
+
+    def send_message(self, payload, timeout=None):
+        return self.post("sendMessage", json=payload, timeout=timeout)
+
+    def warm(self, connections=None):
+        """Open up to ``connections`` pooled sockets with parallel getMe calls."""
+        opened = []
+
+        def ping():
+            try:
+                self.post("getMe")
+                opened.append(1)
+            except requests.RequestException:
+                pass
+
+        threads = [threading.Thread(target=ping, daemon=True)
+                   for _ in range(connections or self.pool_size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"🔌 Bot API pool warmed: {len(opened)}/{len(threads)} connections", flush=True)
+        return len(opened)
@@ -0,0 +1,160 @@
+"""Calling-code -> country resolution.
+
+``country_from_number`` used to run ``phonenumbers.parse``,
+``region_code_for_number`` and a ``pycountry`` lookup for every message.
+``PrefixTrie`` answers longest-prefix questions in O(digits).
+``CountryResolver`` builds one trie from phonenumbers' calling-code table at
+startup.  Calling codes owned by a single region (most of them) are resolved
+from the trie alone.  Shared codes (+1, +7, +44, ...) need the national
+number to tell regions apart, so they go through the full phonenumbers path
+behind an LRU cache.
+
+``CountryTable`` replaces the per-message ``pycountry.countries.lookup()``
+calls in ``get_country_code`` / ``country_to_flag`` / ``get_flag`` with one
+startup-built table keyed by every name variant we see.
+"""
+from collections import namedtuple
+from functools import lru_cache
+from types import MappingProxyType
+
+import phonenumbers
+import pycountry
+
+UNKNOWN = ("Unknown", "", "🌍")
+
+# Spellings the panels and number files use that pycountry does not know
+ALIASES = {
+    "UAE": "AE", "UK": "GB", "USA": "US", "USA / Canada": "US",
+    "Russia": "RU", "Vietnam": "VN", "Turkey": "TR", "Iran": "IR",
+    "Ivory Coast": "CI", "Czech Republic": "CZ", "South Korea": "KR",
+    "North Korea": "KP", "Laos": "LA", "Syria": "SY", "Tanzania": "TZ",
+    "Bolivia": "BO", "Venezuela": "VE", "Moldova": "MD", "Taiwan": "TW",
+    "Palestine": "PS", "Macedonia": "MK", "DR Congo": "CD", "Congo": "CG",
+    "Kosovo": "XK",
+}
+# Regions pycountry has no entry for
+EXTRA_COUNTRIES = {"XK": "Kosovo"}
+
+CountryMeta = namedtuple("CountryMeta", "name iso2 flag flag_html")
+
+
+def flag_for(iso2):
+    return "".join(chr(127397 + ord(c)) for c in iso2.upper())
+
+
+class CountryTable:
+    """Immutable country-name variant -> ``CountryMeta`` table.
+
+    Built once from pycountry (names, official and common names, alpha-2
+    and alpha-3 codes) plus ``ALIASES``; lookups are a case-insensitive
+    dict hit.  ``with_overrides`` returns a new table whose ``flag_html``
+    uses Telegram custom emoji for the given ISO2 codes.
+    """
+
+    def __init__(self, aliases=ALIASES, _index=None, _entries=None):
+        if _index is None:
+            index, entries = {}, {}
+            for iso2, name in EXTRA_COUNTRIES.items():
+                entries[iso2] = CountryMeta(name, iso2, flag_for(iso2), flag_for(iso2))
+                index[name.lower()] = iso2
+            for country in pycountry.countries:
+                iso2 = country.alpha_2
+                flag = flag_for(iso2)
+                entries[iso2] = CountryMeta(country.name, iso2, flag, flag)
+                for attr in ("name", "official_name", "common_name", "alpha_2", "alpha_3"):
+                    value = getattr(country, attr, None)
+                    if value:
+                        index.setdefault(value.lower(), iso2)
+            for alias, iso2 in aliases.items():
+                index[alias.lower()] = iso2
+            _index, _entries = MappingProxyType(index), MappingProxyType(entries)
+        self._index = _index
+        self._entries = _entries
+
+    def get(self, country_name):
+        iso2 = self._index.get(str(country_name or "").strip().lower())
+        return self._entries.get(iso2) if iso2 else None
+
+    def by_iso2(self, iso2):
+        return self._entries.get(str(iso2 or "").upper())
+
+    def with_overrides(self, overrides):
+        """Copy of the table with ``{iso2: custom_emoji_id}`` flag overrides."""
+        entries = dict(self._entries)
+        for iso2, emoji_id in overrides.items():
+            meta = entries.get(iso2.upper())
+            if meta:
+                html = f'<tg-emoji emoji-id="{emoji_id}">{meta.flag}</tg-emoji>'
+                entries[meta.iso2] = meta._replace(flag_html=html)
+        return CountryTable(_index=self._index, _entries=MappingProxyType(entries))
+
+
+country_table = CountryTable()
+
+
+class PrefixTrie:
+    """Longest-prefix lookup over digit strings."""
+
+    _VALUE = object()
+
+    def __init__(self, mapping=()):
+        self._root = {}
+        for prefix, value in dict(mapping).items():
+            self.insert(prefix, value)
+
+    def insert(self, prefix, value):
+        node = self._root
+        for ch in str(prefix):
+            node = node.setdefault(ch, {})
+        node[self._VALUE] = value
+
+    def longest(self, digits, default=None):
+        """Value of the longest key that prefixes ``digits``."""
+        node, found = self._root, default
+        for ch in str(digits):
+            node = node.get(ch)
+            if node is None:
+                break
+            if self._VALUE in node:
+                found = node[self._VALUE]
+        return found
+
+
+class CountryResolver:
+    """Resolve a phone number to ``(name, iso2, flag)``."""
+
+    def __init__(self, table=country_table, cache_size=8192):
+        self._table = table
+        self._codes = PrefixTrie()
+        for code, regions in phonenumbers.COUNTRY_CODE_TO_REGION_CODE.items():
+            regions = tuple(r for r in regions if r != "001")
+            if regions:
+                self._codes.insert(str(code), regions)
+        self._resolve_shared = lru_cache(maxsize=cache_size)(self._parse)
+
+    def info(self, iso2):
+        """``(name, iso2, flag)`` for a region code, UNKNOWN if it is not in the table."""
+        meta = self._table.by_iso2(iso2)
+        return (meta.name, meta.iso2, meta.flag) if meta else UNKNOWN
+
+    def resolve(self, number):
+        digits = "".join(ch for ch in str(number or "") if ch.isdigit())
+        regions = self._codes.longest(digits)
+        if not regions:
+            return UNKNOWN
+        if len(regions) == 1:
+            return self.info(regions[0])
+        return self._resolve_shared(digits)
+
+    def _parse(self, digits):
+        try:
+            region = phonenumbers.region_code_for_number(phonenumbers.parse("+" + digits))
+        except phonenumbers.NumberParseException:
+            return UNKNOWN
+        return self.info(region) if region else UNKNOWN
+
+    def cache_info(self):
+        return self._resolve_shared.cache_info()
+
+
+resolver = CountryResolver()
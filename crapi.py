@@ -0,0 +1,213 @@
+"""Polling helpers for the crapi ``viewstats`` endpoint.
+
+The scraper threads in app.py, kontek.py and maitt.py used to ask for the
+whole 1970..2099 window on every poll and dedupe client-side.  ``HighWaterMark``
+remembers where the previous poll stopped so the next request only covers
+rows the bot has not handled yet.  ``PastOtpSnapshot`` shares one history
+download between every "View Old OTPs" lookup.
+"""
+import json
+import os
+import threading
+import time
+
+from records import normalize_number, record_hex, record_id
+
+EPOCH_DT = "1970-01-01 00:00:00"
+# The panel reports ``dt`` in its own clock/timezone, so the upper bound is
+# left open instead of being derived from our local time.
+OPEN_END_DT = "2099-12-31 23:59:59"
+
+# Catch-up paging: when a whole page is new the scraper probably missed rows,
+# so it re-asks with a larger ``records`` value until the page overlaps rows
+# it has already processed.
+CATCH_UP_GROWTH = 4
+CATCH_UP_MAX_RECORDS = 2000
+
+# "View Old OTPs" reads from one shared download of the newest rows.
+SNAPSHOT_RECORDS = 2000
+SNAPSHOT_TTL = 20
+
+
+def record_key(record):
+    """Identity of a viewstats row among the rows sharing the same second."""
+    return record_hex(record_id(record.get("num"), record.get("dt"), record.get("message")))
+
+
+class HighWaterMark:
+    """Persisted position of the newest ``viewstats`` row already processed.
+
+    Keeps the newest ``dt`` seen plus the keys of every row at that exact
+    second.  Polls send ``dt1 = last_dt`` so the panel only scans and returns
+    rows from that second onwards; rows at the boundary second are told
+    apart by their key.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_dt = None
+        self.keys_at_last_dt = set()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.gap_recovered = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.last_dt = state.get("last_dt")
+            self.keys_at_last_dt = set(state.get("keys", []))
+        except Exception as e:
+            print(f"⚠️ Could not load high-water mark {self.path}: {e}", flush=True)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            state = {"last_dt": self.last_dt, "keys": sorted(self.keys_at_last_dt)}
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠️ Could not save high-water mark {self.path}: {e}", flush=True)
+
+    def params(self, token, records):
+        """Query parameters for the next incremental ``viewstats`` poll."""
+        return {
+            "token": token,
+            "dt1": self.last_dt or EPOCH_DT,
+            "dt2": OPEN_END_DT,
+            "records": records,
+        }
+
+    def is_new(self, record):
+        dt = str(record.get("dt") or "")
+        if self.last_dt is None or dt > self.last_dt:
+            return True
+        if dt < self.last_dt:
+            return False
+        return record_key(record) not in self.keys_at_last_dt
+
+    def has_gap(self, rows, records):
+        """True when a full page came back without a single known row."""
+        if self.last_dt is None or len(rows) < records:
+            return False
+        return all(self.is_new(row) for row in rows)
+
+    def new_rows(self, rows):
+        """Rows past the mark, in panel order; the mark does not move."""
+        with self._lock:
+            return [row for row in rows if self.is_new(row)]
+
+    def advance(self, new_rows):
+        """Move the mark past ``new_rows`` once they have been handled."""
+        with self._lock:
+            for row in new_rows:
+                dt = str(row.get("dt") or "")
+                if self.last_dt is None or dt > self.last_dt:
+                    self.last_dt = dt
+                    self.keys_at_last_dt = set()
+                if dt == self.last_dt:
+                    self.keys_at_last_dt.add(record_key(row))
+                self._dirty = True
+
+
+def catch_up(mark, fetch_page, rows, records, max_records=CATCH_UP_MAX_RECORDS, poller=None):
+    """Page backwards until ``rows`` reaches the high-water mark.
+
+    ``fetch_page(records)`` must return the newest ``records`` rows past the
+    mark, or None on failure.  Returns the widest page fetched and adds the
+    rows it recovered to ``mark.gap_recovered``.  With a ``poller`` every
+    page waits for its rate cap and a failed page counts as a poll error.
+    """
+    first_page = len(rows)
+    while mark.has_gap(rows, records) and records < max_records:
+        records = min(records * CATCH_UP_GROWTH, max_records)
+        if poller is not None:
+            poller.throttle()
+        page = fetch_page(records)
+        if page is None:
+            if poller is not None:
+                poller.record_error()
+            break
+        rows = page
+
+    if mark.has_gap(rows, records):
+        print(f"⚠️ Burst larger than {records} records, older rows may be lost", flush=True)
+
+    recovered = sum(1 for row in rows if mark.is_new(row)) - first_page
+    if recovered > 0:
+        mark.gap_recovered += recovered
+        print(f"🩹 Recovered {recovered} records missed between polls", flush=True)
+    return rows
+
+
+class PastOtpSnapshot:
+    """Shared, short-lived copy of the newest ``viewstats`` rows by number.
+
+    ``fetch()`` returns the raw rows (newest first) or None on failure.  All
+    callers that arrive while a download is running wait for that download
+    instead of starting their own, and the result is reused for ``ttl``
+    seconds.  With a ``poller`` the download waits for the scraper's rate
+    cap, and a failed one counts as a poll error.
+    """
+
+    def __init__(self, fetch, ttl=SNAPSHOT_TTL, poller=None):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.poller = poller
+        self._lock = threading.Lock()
+        self._by_number = None
+        self._fetched_at = 0
+        self._inflight = None
+        self.fetches = 0
+
+    def lookup(self, number):
+        """Rows for ``number`` (newest first), or None if the panel failed."""
+        by_number = self._snapshot()
+        if by_number is None:
+            return None
+        return by_number.get(normalize_number(number), [])
+
+    def _snapshot(self):
+        with self._lock:
+            if self._by_number is not None and time.monotonic() - self._fetched_at < self.ttl:
+                return self._by_number
+            leader = self._inflight is None
+            if leader:
+                self._inflight = {"done": threading.Event(), "result": None}
+            flight = self._inflight
+
+        if not leader:
+            flight["done"].wait()
+            return flight["result"]
+
+        by_number = None
+        try:
+            if self.poller is not None:
+                self.poller.throttle()
+            rows = self._fetch()
+            self.fetches += 1
+            if rows is not None:
+                by_number = {}
+                for row in rows:
+                    by_number.setdefault(normalize_number(row.get("num")), []).append(row)
+        except Exception as e:
+            print(f"⚠️ Past OTP snapshot failed: {e}", flush=True)
+        finally:
+            if by_number is None and self.poller is not None:
+                self.poller.record_error()
+            with self._lock:
+                if by_number is not None:
+                    self._by_number = by_number
+                    self._fetched_at = time.monotonic()
+                flight["result"] = by_number
+                self._inflight = None
+            flight["done"].set()
+        return by_number
@@ -0,0 +1,163 @@
+"""Query builder and pager for the panels' DataTables ``aaData`` endpoints.
+
+neww.py, metrio.py and sunpurple.py used to poll a hard-coded XHR URL that
+always asked for the first page, so anything that scrolled past it during a
+slow poll or a login hiccup was lost.  ``DataTablesQuery`` builds the legacy
+DataTables query string from a filter dict, ``SlidingDateWindow`` keeps the
+``fdate1`` filter to a few recent minutes and ``walk_pages`` keeps paging down
+until it reaches a row the bot has already processed.
+"""
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+OPEN_END = "2099-12-31 23:59:59"  # fdate2 for queries that should reach the newest row
+
+
+class DataTablesQuery:
+    """Legacy (1.9-style) DataTables server-side query for one report table."""
+
+    def __init__(self, url, filters, columns, unsortable=(), sort_column=0, sort_dir="desc"):
+        self.url = url
+        self.filters = dict(filters)
+        self.columns = columns
+        self.unsortable = set(unsortable)
+        self.sort_column = sort_column
+        self.sort_dir = sort_dir
+
+    def params(self, start=0, length=25, **filters):
+        """Query parameters for one page; keyword args override the filters."""
+        params = dict(self.filters)
+        params.update(filters)
+        params.update({
+            "sEcho": 1,
+            "iColumns": self.columns,
+            "sColumns": "," * (self.columns - 1),
+            "iDisplayStart": start,
+            "iDisplayLength": length,
+        })
+        for i in range(self.columns):
+            params[f"mDataProp_{i}"] = i
+            params[f"sSearch_{i}"] = ""
+            params[f"bRegex_{i}"] = "false"
+            params[f"bSearchable_{i}"] = "true"
+            params[f"bSortable_{i}"] = "false" if i in self.unsortable else "true"
+        params.update({
+            "sSearch": "",
+            "bRegex": "false",
+            "iSortCol_0": self.sort_column,
+            "sSortDir_0": self.sort_dir,
+            "iSortingCols": 1,
+            "_": int(time.time() * 1000),
+        })
+        return params
+
+
+def panel_utc_offset(name="PANEL_UTC_OFFSET"):
+    """Panel clock's offset from UTC in minutes, from the environment (None if unset)."""
+    value = os.getenv(name, "").strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"⚠️ Ignoring {name}={value!r}: expected whole minutes east of UTC")
+        return None
+
+
+class SlidingDateWindow:
+    """Rolling ``fdate1`` lower bound for the report filters.
+
+    Each poll asks for rows from the last ``minutes`` minutes plus ``margin``
+    instead of a fixed year-long range.  When polls fail or the loop stalls,
+    the window grows to cover everything since the last successful poll (up
+    to ``max_minutes``) so catch-up paging can still reach the rows it
+    missed.  ``fdate2`` is left open-ended, so a panel clock running ahead
+    of ours cannot hide new rows.
+
+    ``utc_offset`` (minutes, e.g. from ``PANEL_UTC_OFFSET``) puts the window
+    on the panel's clock; when unset our local clock is used.  Either way
+    ``fdate1`` never starts after the newest row the panel has returned
+    (see ``observe``), so a panel clock running behind ours cannot hide
+    them either.
+    """
+
+    def __init__(self, minutes=10, margin=2, max_minutes=24 * 60, utc_offset=None,
+                 fmt="%Y-%m-%d %H:%M:%S"):
+        self.minutes = minutes
+        self.margin = margin
+        self.max_minutes = max_minutes
+        self.utc_offset = utc_offset
+        self.fmt = fmt
+        self.last_ok = None
+        self.newest = None
+
+    def panel_now(self, now=None):
+        now = time.time() if now is None else now
+        if self.utc_offset is None:
+            return datetime.fromtimestamp(now)
+        return datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None) + timedelta(minutes=self.utc_offset)
+
+    def span_minutes(self, now=None):
+        """Minutes the next window looks back, margin included."""
+        now = time.time() if now is None else now
+        span = self.minutes
+        if self.last_ok is not None:
+            span = max(span, (now - self.last_ok) / 60)
+        return min(span + self.margin, self.max_minutes)
+
+    def filters(self, now=None):
+        now = time.time() if now is None else now
+        panel_now = self.panel_now(now)
+        start = panel_now - timedelta(minutes=self.span_minutes(now))
+        if self.newest is not None:
+            start = max(min(start, self.newest - timedelta(minutes=self.margin)),
+                        panel_now - timedelta(minutes=self.max_minutes))
+        return {"fdate1": start.strftime(self.fmt), "fdate2": OPEN_END}
+
+    def history(self, days, now=None):
+        """Wide range for one-off targeted lookups (last ``days`` days)."""
+        panel_now = self.panel_now(now)
+        return {"fdate1": (panel_now - timedelta(days=days)).strftime(self.fmt), "fdate2": OPEN_END}
+
+    def observe(self, dt):
+        """Note a row's panel timestamp; ``fdate1`` stays at or before the newest."""
+        try:
+            seen = datetime.strptime(str(dt), self.fmt)
+        except ValueError:
+            return
+        if self.newest is None or seen > self.newest:
+            self.newest = seen
+
+    def mark_ok(self, polled_at):
+        """Record that every row up to ``polled_at`` has been fetched."""
+        self.last_ok = polled_at
+
+
+def walk_pages(fetch_page, is_known, first_length, page_length, max_rows, throttle=None):
+    """Yield pages newest-first until one reaches an already processed row.
+
+    ``fetch_page(start, length)`` returns the raw ``aaData`` rows of one page.
+    The first page uses ``first_length`` (the normal poll size); catch-up
+    pages use ``page_length``.  Paging stops at a known row, at a short page
+    (end of the table) or after ``max_rows`` rows.  ``throttle()``, when
+    given, is called before every catch-up page so they share the poll's
+    rate cap.
+    """
+    start, length = 0, first_length
+    while True:
+        rows = fetch_page(start, length)
+        reached_known = any(is_known(row) for row in rows)
+        yield rows
+        if reached_known or len(rows) < length:
+            return
+        start += len(rows)
+        if start >= max_rows:
+            logger.warning(f"⚠️ Backlog deeper than {max_rows} rows, older rows skipped")
+            return
+        length = page_length
+        if throttle is not None:
+            throttle()
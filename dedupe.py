@@ -0,0 +1,106 @@
+"""Shared "already handled?" store for every bot.
+
+Replaces the linear ``in`` scan over a 50k ``deque`` (app.py, kontek.py,
+maitt.py) and the set + ``deque`` pair (neww.py, metrio.py, sunpurple.py).
+Keys are reduced to 8-byte digests and kept in insertion order, so membership
+is a dict lookup and eviction pops from the old end.  The store is written to
+disk every ``save_interval`` seconds (16 bytes per entry) and reloaded at
+start, so a restart does not re-broadcast the last page of OTPs.
+"""
+import atexit
+import hashlib
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+_ENTRY = struct.Struct("<8sd")  # key digest, first-seen unix time
+
+
+def _digest(key):
+    if isinstance(key, int):  # already a 64-bit records.record_id
+        return key.to_bytes(8, "big", signed=True)
+    return hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+
+
+class SeenStore:
+    """O(1) membership set with TTL and size-based eviction."""
+
+    def __init__(self, path=None, ttl=86400, max_entries=200000, save_interval=30):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = time.time()
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __contains__(self, key):
+        return _digest(key) in self._seen
+
+    def add(self, key):
+        self.check_and_add(key)
+
+    def check_and_add(self, key):
+        """True if ``key`` was already seen; otherwise remember it and return False."""
+        digest = _digest(key)
+        now = time.time()
+        with self._lock:
+            if digest in self._seen:
+                return True
+            self._seen[digest] = now
+            self._dirty = True
+            self._evict(now)
+        return False
+
+    def _evict(self, now):
+        cutoff = now - self.ttl
+        while self._seen:
+            digest, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                blob = f.read()
+        except OSError as e:
+            print(f"⚠️ Could not load seen store {self.path}: {e}", flush=True)
+            return
+        usable = len(blob) - len(blob) % _ENTRY.size
+        with self._lock:
+            for digest, seen_at in _ENTRY.iter_unpack(blob[:usable]):
+                self._seen[digest] = seen_at
+            self._evict(time.time())
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not self.path:
+                return
+            self._evict(time.time())
+            blob = b"".join(_ENTRY.pack(d, t) for d, t in self._seen.items())
+            self._dirty = False
+            self._last_save = time.time()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Could not save seen store {self.path}: {e}", flush=True)
+
+    def maybe_save(self):
+        """Save if something changed and ``save_interval`` has passed."""
+        if self._dirty and time.time() - self._last_save >= self.save_interval:
+            self.save()
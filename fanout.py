@@ -0,0 +1,78 @@
+"""Process-wide executor for sending one message to many chats.
+
+``send_to_telegram`` in the DataTables bots built a new ``ThreadPoolExecutor``
+for every OTP, even a single-recipient DM, so each message paid to spawn and
+join its threads.  ``FanOut`` is created once at startup and reused.  A
+semaphore bounds how many sends may be queued or running, so a huge target
+list makes the submitter wait instead of piling up work.  It also counts
+how long tasks waited for a worker and how many are in flight.
+
+Submit only from threads outside the pool: a task that waits on its own
+``FanOut`` can deadlock once every worker is doing the same.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FanOut:
+    """Long-lived, bounded thread pool with queue-wait and in-flight metrics."""
+
+    def __init__(self, workers=8, capacity=None, name="FanOut"):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(capacity or workers * 4)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _run(self, fn, item, submitted):
+        waited = time.monotonic() - submitted
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        try:
+            return fn(item)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+            self._slots.release()
+
+    def submit(self, fn, item):
+        """Run ``fn(item)`` on the pool; blocks while the pool is at capacity."""
+        self._slots.acquire()
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(self._run, fn, item, time.monotonic())
+
+    def map(self, fn, items, default=None):
+        """``{item: fn(item)}``, with ``default`` for calls that raised.
+
+        A single item runs inline on the caller's thread.
+        """
+        items = list(items)
+        if len(items) == 1:
+            try:
+                return {items[0]: fn(items[0])}
+            except Exception:
+                return {items[0]: default}
+        futures = [(item, self.submit(fn, item)) for item in items]
+        results = {}
+        for item, future in futures:
+            try:
+                results[item] = future.result()
+            except Exception:
+                results[item] = default
+        return results
+
+    def status(self):
+        with self._lock:
+            avg = self.wait_total / self.completed * 1000 if self.completed else 0.0
+            return (f"FanOut: in_flight={self.in_flight} queued={self.queued} done={self.completed} "
+                    f"wait_avg={avg:.0f}ms wait_max={self.wait_max * 1000:.0f}ms")
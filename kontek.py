@@ -6,24 +6,38 @@ import random
 from flask import Flask, Response
 import threading
 import requests
-import re
 import html
-import phonenumbers
-import pycountry
 import time
-import sqlite3
-from queue import Queue
 from datetime import datetime, timedelta
-from collections import deque
+from crapi import HighWaterMark, PastOtpSnapshot, SNAPSHOT_RECORDS, catch_up
+from poller import AdaptivePoller
+from dedupe import SeenStore
+from records import from_viewstats, record_id
+from storage import Database, WriteBehind, exit_on_sigterm
+from ratelimit import TelegramLimiter, limit_bot
+from shards import ShardedQueue
+from outbox import Outbox
+from botapi import BotApi
+from subscribers import SubscriberIndex
+from countries import country_table, resolver as country_resolver
 
 # ==================== CONFIG ====================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = 6102951142
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+telegram_limiter = TelegramLimiter()
+limit_bot(bot, telegram_limiter)
 
 DATA_FILE = "bot_data.json"
 NUMBERS_DIR = "numbers"
 DB_FILE = "bot_database.db"
+db = Database(DB_FILE)
+db_writer = WriteBehind(db)  # Batched stats/cache writes, off the delivery path
+HWM_FILE = "viewstats_hwm.json"
+SEEN_FILE = "seen_messages.bin"
+POLL_RECORDS = 10
+BACKFILL_INTERVAL = 600  # Refill past_otps_cache from the panel every 10 min
+PAST_OTP_RETENTION = 7 * 86400  # past_otps_cache keeps records whose panel timestamp is newer than this
 os.makedirs(NUMBERS_DIR, exist_ok=True)
 
 # API Config
@@ -35,19 +49,22 @@ BACKUP = "https://t.me/NomorGo"
 CHANNEL_LINK = "https://t.me/NomorGoBot"
 
 # ==================== QUEUES ====================
-group_queue = Queue(maxsize=1000)
-personal_queue = Queue(maxsize=5000)
-seen_messages = deque(maxlen=50000)
-
-# ==================== REGEX PATTERNS ====================
-KEYWORD_REGEX = re.compile(r"(otp|code|pin|password|verify)[^\d]{0,10}(\d[\d\-]{3,8})", re.I)
-REVERSE_REGEX = re.compile(r"(\d[\d\-]{3,8})[^\w]{0,10}(otp|code|pin|password|verify)", re.I)
-GENERIC_REGEX = re.compile(r"\d{2,4}[-]?\d{2,4}")
-UNICODE_CLEAN = re.compile(r"[\u200f\u200e\u202a-\u202e]")
+outbox = Outbox(db)  # Outbound messages stay on disk until Telegram accepts them
+OUTBOX_BATCH = 20
+GROUP_TTL = 180  # Seconds after fetch before a group post is shed; the code has likely expired
+PERSONAL_TTL = 600  # DMs are kept longer: the user is waiting for this number's code
+GROUP_BACKLOG = 20  # Waiting posts per group (about a minute of its 20/min budget); older ones are shed
+group_queue = outbox.lane("group")
+PERSONAL_SHARDS = 16  # DM workers; a chat always maps to the same one, so its OTPs stay in order
+personal_queue = ShardedQueue(PERSONAL_SHARDS, factory=lambda shard: outbox.lane(f"dm{shard}"))
+telegram_api = BotApi(BOT_TOKEN, pool_size=PERSONAL_SHARDS + 1)  # DM shards + group sender
+seen_messages = SeenStore(SEEN_FILE, ttl=86400)  # Delivered message ids, persisted
+viewstats_mark = HighWaterMark(HWM_FILE)
+viewstats_poller = AdaptivePoller(min_interval=1.0, max_interval=15)
 
 # ==================== DATABASE SETUP ====================
 def init_db():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     
     c.execute('''CREATE TABLE IF NOT EXISTS user_numbers
@@ -57,9 +74,6 @@ def init_db():
                  (chat_id INTEGER PRIMARY KEY, total_otps INTEGER DEFAULT 0, 
                   last_otp REAL, joined_at REAL)''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS message_cache
-                 (msg_id TEXT PRIMARY KEY, created_at REAL)''')
-    
     c.execute('''CREATE TABLE IF NOT EXISTS past_otps_cache
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   number TEXT,
@@ -67,11 +81,25 @@ def init_db():
                   message TEXT,
                   otp TEXT,
                   timestamp TEXT,
-                  received_at REAL)''')
+                  received_at REAL,
+                  record_id INTEGER)''')
     
     c.execute('''CREATE INDEX IF NOT EXISTS idx_number ON past_otps_cache(number)''')
     c.execute('''CREATE INDEX IF NOT EXISTS idx_received_at ON past_otps_cache(received_at)''')
     
+    # One row per panel record (records.record_id), so the backfill can re-insert freely
+    columns = {row[1] for row in c.execute("PRAGMA table_info(past_otps_cache)")}
+    if "record_id" not in columns:
+        c.execute("ALTER TABLE past_otps_cache ADD COLUMN record_id INTEGER")
+    c.execute("SELECT id, number, timestamp, message FROM past_otps_cache WHERE record_id IS NULL")
+    c.executemany("UPDATE past_otps_cache SET record_id = ? WHERE id = ?",
+                  [(record_id(number, dt, message), row_id) for row_id, number, dt, message in c.fetchall()])
+    c.execute('''DELETE FROM past_otps_cache WHERE id NOT IN
+                 (SELECT MIN(id) FROM past_otps_cache GROUP BY record_id)''')
+    c.execute("DROP INDEX IF EXISTS idx_past_record")
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_past_record_id
+                 ON past_otps_cache(record_id)''')
+    
     conn.commit()
     conn.close()
 
@@ -89,22 +117,6 @@ active_users = set()
 past_otp_fetch_cooldown = {}
 REQUIRED_CHANNELS = ["@NomorGo","@NomorGoNums","@sunilhubbackup"]
 
-# Service name mappings
-SERVICE_CODES = {
-    "whatsapp": "WA", "WhatsApp": "WA", "WHATSAPP": "WA",
-    "telegram": "TG", "Telegram": "TG", "TELEGRAM": "TG",
-    "instagram": "IG", "Instagram": "IG", "INSTAGRAM": "IG",
-    "facebook": "FB", "Facebook": "FB", "FACEBOOK": "FB",
-    "twitter": "TW", "Twitter": "TW", "TWITTER": "TW",
-    "google": "GO", "Google": "GO", "GOOGLE": "GO",
-    "amazon": "AZ", "Amazon": "AZ", "AMAZON": "AZ",
-    "snapchat": "SC", "Snapchat": "SC", "SNAPCHAT": "SC",
-    "tiktok": "TT", "TikTok": "TT", "TIKTOK": "TT",
-    "linkedin": "LI", "LinkedIn": "LI", "LINKEDIN": "LI",
-    "uber": "UB", "Uber": "UB", "UBER": "UB",
-    "paypal": "PP", "PayPal": "PP", "PAYPAL": "PP",
-}
-
 # ==================== DATA FUNCTIONS ====================
 def load_data():
     global data, numbers_by_country, current_country, OTP_GROUP_IDS, AUTO_DELETE_MINUTES
@@ -131,16 +143,20 @@ def save_data():
 load_data()
 
 # ==================== DATABASE HELPERS ====================
-def get_chat_by_number(number):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+subscribers = SubscriberIndex()  # number -> chat_ids, mirrors user_numbers
+
+def load_subscribers():
+    conn = db.connect()
     c = conn.cursor()
-    c.execute("SELECT chat_id FROM user_numbers WHERE number=?", (number,))
-    result = c.fetchone()
+    c.execute("SELECT number, chat_id FROM user_numbers")
+    subscribers.load(c.fetchall())
     conn.close()
-    return result[0] if result else None
+
+def get_chat_by_number(number):
+    return next(iter(subscribers.chats_for(number)), None)
 
 def get_number_by_chat(chat_id):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("SELECT number FROM user_numbers WHERE chat_id=? ORDER BY assigned_at DESC LIMIT 1", (chat_id,))
     result = c.fetchone()
@@ -148,62 +164,90 @@ def get_number_by_chat(chat_id):
     return result[0] if result else None
 
 def assign_number(number, chat_id, country):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("INSERT OR REPLACE INTO user_numbers VALUES (?, ?, ?, ?)",
               (number, chat_id, country, time.time()))
     conn.commit()
     conn.close()
+    subscribers.assign(number, chat_id)
 
-def increment_user_stats(chat_id):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("""INSERT INTO user_stats (chat_id, total_otps, last_otp, joined_at) 
-                 VALUES (?, 1, ?, ?) 
-                 ON CONFLICT(chat_id) DO UPDATE SET 
-                 total_otps = total_otps + 1, last_otp = ?""",
-              (chat_id, time.time(), time.time(), time.time()))
-    conn.commit()
-    conn.close()
+load_subscribers()
 
-def cache_past_otp(number, sender, message, otp, timestamp):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    c = conn.cursor()
-    try:
-        c.execute("""INSERT INTO past_otps_cache 
-                     (number, sender, message, otp, timestamp, received_at)
-                     VALUES (?, ?, ?, ?, ?, ?)""",
-                  (number, sender, message, otp, timestamp, time.time()))
-        conn.commit()
-    except:
-        pass
-    conn.close()
+def increment_user_stats(chat_id):
+    now = time.time()
+    db_writer.submit("""INSERT INTO user_stats (chat_id, total_otps, last_otp, joined_at) 
+                        VALUES (?, 1, ?, ?) 
+                        ON CONFLICT(chat_id) DO UPDATE SET 
+                        total_otps = total_otps + 1, last_otp = ?""",
+                     (chat_id, now, now, now))
+
+def cache_past_otp(record):
+    db_writer.submit("""INSERT OR IGNORE INTO past_otps_cache 
+                        (number, sender, message, otp, timestamp, received_at, record_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                     (record.normalized, record.sender, record.message, record.otp, record.dt, time.time(),
+                      record.id))
 
 def get_cached_past_otps(number, limit=50):
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("""SELECT sender, message, otp, timestamp 
                  FROM past_otps_cache 
                  WHERE number=? 
-                 ORDER BY received_at DESC 
+                 ORDER BY timestamp DESC 
                  LIMIT ?""", (number, limit))
     results = c.fetchall()
     conn.close()
     return results
 
+def get_past_otp_summary(number):
+    """(messages, distinct senders, messages with an OTP) cached for a number"""
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute("""SELECT COUNT(*), COUNT(DISTINCT sender), COUNT(otp)
+                 FROM past_otps_cache 
+                 WHERE number=?""", (number,))
+    result = c.fetchone()
+    conn.close()
+    return result
+
+def past_cache_cutoff():
+    """Oldest panel timestamp past_otps_cache keeps ("YYYY-MM-DD HH:MM:SS", compares as text)"""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - PAST_OTP_RETENTION))
+
+def cache_past_records(records):
+    """Bulk-insert raw viewstats rows into past_otps_cache, returns rows added"""
+    now = time.time()
+    cutoff = past_cache_cutoff()
+    # Rows already past retention would only be deleted again by clean_old_cache
+    rows = [
+        (rec.normalized, rec.sender, rec.message, rec.otp, rec.dt, now, rec.id)
+        for rec in map(from_viewstats, records)
+        if rec.dt >= cutoff
+    ]
+    conn = db.connect()
+    c = conn.cursor()
+    before = conn.total_changes
+    c.executemany("""INSERT OR IGNORE INTO past_otps_cache 
+                     (number, sender, message, otp, timestamp, received_at, record_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+    added = conn.total_changes - before
+    conn.commit()
+    conn.close()
+    return added
+
 def is_message_seen(msg_id):
-    if msg_id in seen_messages:
-        return True
-    seen_messages.append(msg_id)
-    return False
+    return msg_id in seen_messages
+
+def mark_message_seen(msg_id):
+    seen_messages.add(msg_id)
 
 def clean_old_cache():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
-    cutoff = time.time() - 86400
-    c.execute("DELETE FROM message_cache WHERE created_at < ?", (cutoff,))
-    otp_cutoff = time.time() - (7 * 86400)
-    c.execute("DELETE FROM past_otps_cache WHERE received_at < ?", (otp_cutoff,))
+    # By the record's own timestamp: the backfill re-inserts rows with a fresh received_at
+    c.execute("DELETE FROM past_otps_cache WHERE timestamp < ?", (past_cache_cutoff(),))
     conn.commit()
     conn.close()
 
@@ -216,26 +260,15 @@ def index():
 
 @app.route("/health")
 def health():
-    return Response(f"OK - Queue: G={group_queue.qsize()} P={personal_queue.qsize()}", status=200)
+    healthy = db_writer.alive()
+    return Response(
+        f"{'OK' if healthy else 'DEGRADED'} - Queue: G={group_queue.qsize()} P={personal_queue.qsize()} "
+        f"GapRecovered={viewstats_mark.gap_recovered} {viewstats_poller.status()} "
+        f"{db_writer.status()} {telegram_limiter.status()} {outbox.status()}",
+        status=200 if healthy else 503
+    )
 
 # ==================== HELPER FUNCTIONS ====================
-def extract_otp(message: str) -> str | None:
-    message = UNICODE_CLEAN.sub("", message)
-    
-    match = KEYWORD_REGEX.search(message)
-    if match:
-        return re.sub(r"\D", "", match.group(2))
-    
-    match = REVERSE_REGEX.search(message)
-    if match:
-        return re.sub(r"\D", "", match.group(1))
-    
-    match = GENERIC_REGEX.findall(message)
-    if match:
-        return re.sub(r"\D", "", match[0])
-    
-    return None
-
 def mask_number(number: str) -> str:
     number = number.strip()
     if len(number) <= 4:
@@ -243,31 +276,8 @@ def mask_number(number: str) -> str:
     return f"{number[:2]}DDX{number[-4:]}"
 
 def country_from_number(number: str) -> tuple[str, str]:
-    try:
-        parsed = phonenumbers.parse("+" + number)
-        region = phonenumbers.region_code_for_number(parsed)
-        if not region:
-            return "Unknown", "🌍"
-        country_obj = pycountry.countries.get(alpha_2=region)
-        if not country_obj:
-            return "Unknown", "🌍"
-        flag = "".join([chr(127397 + ord(c)) for c in region])
-        return country_obj.name, flag
-    except:
-        return "Unknown", "🌍"
-
-def get_country_code(country_name: str) -> str:
-    try:
-        country = pycountry.countries.lookup(country_name)
-        return country.alpha_2.upper()
-    except:
-        return country_name[:2].upper()
-
-def get_service_code(sender: str) -> str:
-    for service, code in SERVICE_CODES.items():
-        if service.lower() in sender.lower():
-            return code
-    return sender[:2].upper() if len(sender) >= 2 else sender.upper()
+    name, _, flag = country_resolver.resolve(number)
+    return name, flag
 
 def delete_message_safe(chat_id, message_id):
     try:
@@ -279,53 +289,33 @@ def delete_message_safe(chat_id, message_id):
 # ==================== MESSAGE FORMATTERS ====================
 # ---------------- FLAG OVERRIDE SYSTEM ----------------
 flag_overrides = {}
+flag_table = country_table
 
 def load_flag_overrides():
-    global flag_overrides
+    global flag_overrides, flag_table
     flag_overrides = data.get("flag_overrides", {})
+    flag_table = country_table.with_overrides(flag_overrides)
 
 def save_flag_overrides():
+    global flag_table
     data["flag_overrides"] = flag_overrides
+    flag_table = country_table.with_overrides(flag_overrides)
     save_data()
 
 load_flag_overrides()
 
-def get_flag(country_name: str) -> str:
-    try:
-        country = pycountry.countries.lookup(country_name)
-        code = country.alpha_2.upper()
-    except:
-        return "🌍"
-    regular_flag = "".join(chr(127397 + ord(c)) for c in code)
-    emoji_id = flag_overrides.get(code)
-    if emoji_id:
-        return f'<tg-emoji emoji-id="{emoji_id}">{regular_flag}</tg-emoji>'
-    return regular_flag
-
-def get_service_emoji(sender: str) -> str:
-    s = sender.lower()
-    if "whatsapp" in s:
-        return '<tg-emoji emoji-id="5334998226636390258">📱</tg-emoji>'
-    elif "telegram" in s:
-        return '<tg-emoji emoji-id="5330237710655306682">✈️</tg-emoji>'
-    elif "instagram" in s:
-        return '<tg-emoji emoji-id="5319160079465857105">📸</tg-emoji>'
-    elif "facebook" in s:
-        return '<tg-emoji emoji-id="5323261730283863478">👤</tg-emoji>'
-    return '<tg-emoji emoji-id="6125390694363175728">🌐</tg-emoji>'
+def get_flag(iso2: str) -> str:
+    meta = flag_table.by_iso2(iso2)
+    return meta.flag_html if meta else "🌍"
 
 def format_group_message(record):
-    number = record.get("num") or "Unknown"
-    sender = record.get("cli") or "Unknown"
-    message = record.get("message") or ""
-
-    country, _ = country_from_number(number)
-    country_code = get_country_code(country)
-    flag = get_flag(country)
-    service_code = get_service_code(sender)
-    service_emoji = get_service_emoji(sender)
+    number = record.number or "Unknown"
+    sender, message = record.sender, record.message
+
+    country_code, flag = record.iso2, get_flag(record.iso2)
+    service_code, service_emoji = record.service_code, record.service_emoji
     masked = mask_number(number)
-    otp = extract_otp(message)
+    otp = record.otp
 
     formatted = (
         f'<tg-emoji emoji-id="5382357040008021292">⚡</tg-emoji> '
@@ -334,7 +324,7 @@ def format_group_message(record):
         
     )
 
-    msg_hash = hash(f"{number}{message}{time.time()}")
+    msg_hash = record.id
     cache_full_message(msg_hash, number, sender, message)
 
     keyboard = {
@@ -351,17 +341,12 @@ def format_group_message(record):
     return formatted, keyboard
 
 def format_personal_message(record):
-    number = record.get("num") or "Unknown"
-    sender = record.get("cli") or "Unknown"
-    message = record.get("message") or ""
-
-    country, _ = country_from_number(number)
-    country_code = get_country_code(country)
-    flag = get_flag(country)
-    service_emoji = get_service_emoji(sender)
-    service_code = get_service_code(sender)
-    masked = mask_number(number)
-    otp = extract_otp(message) or "N/A"
+    number = record.number or "Unknown"
+    sender, message = record.sender, record.message
+
+    country, flag = record.country, get_flag(record.iso2)
+    service_emoji = record.service_emoji
+    otp = record.otp or "N/A"
 
     return (
         f'<tg-emoji emoji-id="5382357040008021292">⚡</tg-emoji> <b>OTP RECEIVED!</b>\n'
@@ -378,7 +363,7 @@ def format_personal_message(record):
 
 def cache_full_message(msg_hash, number, sender, message):
     """Cache full message for view full button"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     try:
         c.execute("""CREATE TABLE IF NOT EXISTS full_messages
@@ -393,7 +378,7 @@ def cache_full_message(msg_hash, number, sender, message):
 
 def get_full_message(msg_hash):
     """Get full message from cache"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     try:
         c.execute("SELECT message FROM full_messages WHERE msg_hash=?", (msg_hash,))
@@ -406,17 +391,12 @@ def get_full_message(msg_hash):
 
 def format_personal_message(record):
     """Format message for personal DM"""
-    number = record.get("num") or "Unknown"
-    sender = record.get("cli") or "Unknown"
-    message = record.get("message") or ""
+    number = record.number or "Unknown"
+    sender, message = record.sender, record.message
     
-    country, flag = country_from_number(number)
-    country_code = get_country_code(country)
-    service_code = get_service_code(sender)
+    flag, country_code, service_code = record.flag, record.iso2, record.service_code
     masked = mask_number(number)
     
-    otp = extract_otp(message)
-    
     formatted = (
         f"{flag} {country_code} | {masked} | {service_code}\n\n"
         f"<b>Full Number:</b> <code>{html.escape(number)}</code>\n"
@@ -427,110 +407,151 @@ def format_personal_message(record):
     return formatted
 
 # ==================== THREAD 1: OTP SCRAPER ====================
+def fetch_viewstats_page(records):
+    """Fetch the newest `records` rows past the high-water mark (None on failure)"""
+    try:
+        response = requests.get(
+            f"{BASE_URL}/viewstats",
+            params=viewstats_mark.params(API_TOKEN, records),
+            timeout=15
+        )
+        stats = response.json()
+    except Exception as e:
+        print(f"⚠️ Catch-up fetch failed: {e}", flush=True)
+        return None
+    if stats.get("status") != "success":
+        return None
+    return stats.get("data", [])
+
+def fetch_past_snapshot():
+    """Fetch the newest SNAPSHOT_RECORDS rows for "View Old OTPs" (None on failure)"""
+    response = requests.get(
+        f"{BASE_URL}/viewstats",
+        params={
+            "token": API_TOKEN,
+            "dt1": "1970-01-01 00:00:00",
+            "dt2": "2099-12-31 23:59:59",
+            "records": SNAPSHOT_RECORDS
+        },
+        timeout=15
+    )
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    if data.get("status") != "success":
+        return None
+    return data.get("data", [])
+
+past_otp_snapshot = PastOtpSnapshot(fetch_past_snapshot, poller=viewstats_poller)
+
 def otp_scraper_thread():
     print("🟢 OTP Scraper Started", flush=True)
     
     while True:
+        viewstats_poller.wait()
         try:
             response = requests.get(
                 f"{BASE_URL}/viewstats",
-                params={
-                    "token": API_TOKEN,
-                    "dt1": "1970-01-01 00:00:00",
-                    "dt2": "2099-12-31 23:59:59",
-                    "records": 10
-                },
+                params=viewstats_mark.params(API_TOKEN, POLL_RECORDS),
                 timeout=8
             )
             
             # Empty response check
             if not response.text.strip():
                 print("⚠️ API returned empty response - token invalid ya server down", flush=True)
-                time.sleep(5)
+                viewstats_poller.record_error()
                 continue
             
             try:
                 stats = response.json()
             except Exception:
                 print(f"⚠️ API non-JSON response: {response.text[:100]}", flush=True)
-                time.sleep(5)
+                viewstats_poller.record_error()
                 continue
             
             if stats.get("status") == "error":
                 print(f"⚠️ API error: {stats.get('msg', 'Unknown')}", flush=True)
-                time.sleep(10)
+                viewstats_poller.record_error()
                 continue
             
             if stats.get("status") == "success":
-                for record in stats["data"]:
-                    msg_id = f"{record.get('dt')}_{record.get('num')}_{record.get('message', '')[:50]}"
+                rows = catch_up(viewstats_mark, fetch_viewstats_page, stats["data"], POLL_RECORDS,
+                                poller=viewstats_poller)
+                new_records = viewstats_mark.new_rows(rows)
+                for row in new_records:
+                    record = from_viewstats(row)
                     
-                    if is_message_seen(msg_id):
+                    if is_message_seen(record.id):
                         continue
                     
-                    number = str(record.get("num", "")).lstrip("0").lstrip("+")
-                    sender = record.get("cli", "Unknown")
-                    message = record.get("message", "")
-                    timestamp = record.get("dt", "")
-                    otp = extract_otp(message)
+                    number, sender, otp = record.normalized, record.sender, record.otp
                     
-                    cache_past_otp(number, sender, message, otp, timestamp)
+                    cache_past_otp(record)
                     
-                    try:
-                        group_queue.put_nowait((record, time.time()))
-                        print(f"📤 Queued: {number} | {sender} | OTP: {otp or 'N/A'}", flush=True)
-                    except:
-                        print("⚠️ Group queue full!", flush=True)
+                    queue_group_message(record)
+                    print(f"📤 Queued: {number} | {sender} | OTP: {otp or 'N/A'}", flush=True)
                     
                     chat_id = get_chat_by_number(number)
                     if chat_id:
-                        try:
-                            personal_queue.put_nowait((record, chat_id, time.time()))
-                        except:
-                            print(f"⚠️ Personal queue full for {chat_id}!", flush=True)
-            
-            time.sleep(3)
+                        queue_personal_message(record, chat_id)
+                    
+                    # Seen only once its messages are in the outbox; a failed write is retried next poll
+                    mark_message_seen(record.id)
+                
+                viewstats_mark.advance(new_records)
+                viewstats_mark.save()
+                seen_messages.maybe_save()
+                viewstats_poller.record(len(new_records))
             
         except requests.exceptions.Timeout:
             print("⚠️ API timeout - retrying...", flush=True)
-            time.sleep(3)
+            viewstats_poller.record_error()
         except requests.exceptions.ConnectionError:
             print("⚠️ API connection error - retrying...", flush=True)
-            time.sleep(5)
+            viewstats_poller.record_error()
         except Exception as e:
             print(f"❌ Scraper error: {e}", flush=True)
-            time.sleep(2)
+            viewstats_poller.record_error()
 
 
 # ==================== THREAD 2: GROUP SENDER ====================
+def queue_group_message(record):
+    """Persist the group post for every OTP group"""
+    msg, kb = format_group_message(record)
+    fetch_time = time.time()
+    for group_id in OTP_GROUP_IDS:
+        group_queue.put(group_id, {
+            "chat_id": group_id,
+            "text": msg[:4000],
+            "parse_mode": "HTML",
+            "reply_markup": json.dumps(kb)
+        }, deadline=fetch_time + GROUP_TTL, fetch_time=fetch_time)
+
 def group_sender_thread():
     print("🟢 Group Sender Started", flush=True)
     
     while True:
+        done = []
         try:
-            record, fetch_time = group_queue.get()
-            
-            msg, kb = format_group_message(record)
-            
-            # Send to all configured groups
-            for group_id in OTP_GROUP_IDS:
-                payload = {
-                    "chat_id": group_id,
-                    "text": msg[:4000],
-                    "parse_mode": "HTML",
-                    "reply_markup": json.dumps(kb)
-                }
-                
-                response = requests.post(
-                    f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                    json=payload,
-                    timeout=5
-                )
+            # Under load, the oldest posts go first; DMs are never trimmed
+            group_queue.shed_backlog(GROUP_BACKLOG * len(OTP_GROUP_IDS))
+            for item in group_queue.claim(OUTBOX_BATCH):
+                if item.expired():
+                    group_queue.drop([item.id], "expired")
+                    continue
+                telegram_limiter.acquire(item.chat_id)
+                try:
+                    response = telegram_api.send_message(item.payload)
+                except requests.RequestException as e:
+                    print(f"❌ Group send error: {e}", flush=True)
+                    group_queue.retry([item.id])
+                    continue
                 
                 if response.status_code == 200:
-                    delay = time.time() - fetch_time
+                    done.append(item.id)
+                    delay = time.time() - item.meta["fetch_time"]
                     print(f"✅ Group sent (delay: {delay:.2f}s)", flush=True)
-                    
+
                     # Schedule auto-delete if enabled
                     if AUTO_DELETE_MINUTES > 0:
                         result = response.json()
@@ -539,61 +560,84 @@ def group_sender_thread():
                             threading.Timer(
                                 AUTO_DELETE_MINUTES * 60,
                                 delete_message_safe,
-                                args=(group_id, message_id)
+                                args=(item.chat_id, message_id)
                             ).start()
-                            
                 elif response.status_code == 429:
                     retry_after = response.json().get("parameters", {}).get("retry_after", 2)
-                    print(f"⏳ Rate limited, waiting {retry_after}s", flush=True)
-                    time.sleep(retry_after)
-                    group_queue.put((record, fetch_time))
+                    print(f"⏳ Rate limited, backing off {retry_after}s", flush=True)
+                    telegram_limiter.backoff(item.chat_id, retry_after)
+                    group_queue.retry([item.id], delay=retry_after)
+                elif response.status_code >= 500:
+                    print(f"❌ Group send failed: {response.status_code}, will retry", flush=True)
+                    group_queue.retry([item.id])
                 else:
+                    # Telegram rejected the message itself; resending will not help
                     print(f"❌ Group send failed: {response.status_code}", flush=True)
-            
-            time.sleep(0.5)
-            
+                    done.append(item.id)
+
         except Exception as e:
             print(f"❌ Group sender error: {e}", flush=True)
             time.sleep(1)
+        finally:
+            group_queue.ack(done)
 
 # ==================== THREAD 3: PERSONAL DM SENDER ====================
-def personal_sender_thread():
-    print("🟢 Personal Sender Started", flush=True)
+def queue_personal_message(record, chat_id):
+    """Persist a DM on the chat's shard"""
+    fetch_time = time.time()
+    personal_queue.shard_for(chat_id).put(chat_id, {
+        "chat_id": chat_id,
+        "text": format_personal_message(record)[:4000],
+        "parse_mode": "HTML"
+    }, deadline=fetch_time + PERSONAL_TTL, fetch_time=fetch_time)
+
+def personal_sender_thread(queue):
+    """Send one shard's DMs in order; other shards run in parallel"""
+    print(f"🟢 Personal Sender {threading.current_thread().name} Started", flush=True)
     
     while True:
+        done = []
         try:
-            record, chat_id, fetch_time = personal_queue.get()
-            
-            msg = format_personal_message(record)
-            
-            payload = {
-                "chat_id": chat_id,
-                "text": msg[:4000],
-                "parse_mode": "HTML"
-            }
-            
-            response = requests.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                json=payload,
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                increment_user_stats(chat_id)
-                delay = time.time() - fetch_time
-                print(f"✅ DM sent to {chat_id} (delay: {delay:.2f}s)", flush=True)
-            elif response.status_code == 429:
-                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
-                time.sleep(retry_after)
-                personal_queue.put((record, chat_id, fetch_time))
-            else:
-                print(f"❌ DM failed for {chat_id}: {response.status_code}", flush=True)
-            
-            time.sleep(0.2)
-            
+            items = queue.claim(OUTBOX_BATCH)
+            for index, item in enumerate(items):
+                chat_id = item.chat_id
+                if item.expired():
+                    queue.drop([item.id], "expired")
+                    continue
+                
+                # Retry a 429 in place rather than re-queueing, so this chat's
+                # later OTPs cannot overtake it
+                while True:
+                    telegram_limiter.acquire(chat_id)
+                    try:
+                        response = telegram_api.send_message(item.payload)
+                    except requests.RequestException as e:
+                        print(f"❌ DM error for {chat_id}: {e}", flush=True)
+                        response = None
+                        break
+                    if response.status_code != 429:
+                        break
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                    print(f"⏳ DM to {chat_id} rate limited, backing off {retry_after}s", flush=True)
+                    telegram_limiter.backoff(chat_id, retry_after)
+                
+                if response is None or response.status_code >= 500:
+                    # Put this DM and everything behind it back, in order
+                    queue.retry([later.id for later in items[index:]])
+                    break
+                done.append(item.id)
+                if response.status_code == 200:
+                    increment_user_stats(chat_id)
+                    delay = time.time() - item.meta["fetch_time"]
+                    print(f"✅ DM sent to {chat_id} (delay: {delay:.2f}s)", flush=True)
+                else:
+                    print(f"❌ DM failed for {chat_id}: {response.status_code}", flush=True)
+
         except Exception as e:
             print(f"❌ Personal sender error: {e}", flush=True)
             time.sleep(1)
+        finally:
+            queue.ack(done)
 
 # ==================== CALLBACK HANDLERS ====================
 @bot.callback_query_handler(func=lambda call: call.data.startswith("copy_"))
@@ -843,7 +887,7 @@ def bot_stats(message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("SELECT COUNT(*) FROM past_otps_cache")
     cache_count = c.fetchone()[0]
@@ -856,6 +900,7 @@ def bot_stats(message):
 📥 Group Queue: {group_queue.qsize()}
 📨 Personal Queue: {personal_queue.qsize()}
 💾 Cached Messages: {len(seen_messages)}
+🩹 Gap-Recovered Records: {viewstats_mark.gap_recovered}
 💿 Past OTPs Cache: {cache_count}
 🌍 Countries: {len(numbers_by_country)}
 📞 Total Numbers: {sum(len(v) for v in numbers_by_country.values())}
@@ -879,7 +924,6 @@ def broadcast_message(message):
         try:
             bot.send_message(user_id, f"📢 <b>Broadcast:</b>\n\n{text}")
             success += 1
-            time.sleep(0.05)
         except:
             fail += 1
     
@@ -890,7 +934,7 @@ def clear_cache(message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("DELETE FROM past_otps_cache")
     deleted = c.rowcount
@@ -953,7 +997,7 @@ def start(message):
 def my_stats(message):
     chat_id = message.chat.id
     
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     c = conn.cursor()
     c.execute("SELECT total_otps, last_otp FROM user_stats WHERE chat_id=?", (chat_id,))
     result = c.fetchone()
@@ -1055,109 +1099,72 @@ def send_random_number(chat_id, country=None, edit=False):
         msg = bot.send_message(chat_id, text, reply_markup=markup)
         user_messages[chat_id] = msg
 
-def fetch_past_otps(chat_id, number):
-    """Fetch and display past OTPs"""
-    now = time.time()
-    if chat_id in past_otp_fetch_cooldown:
-        time_passed = now - past_otp_fetch_cooldown[chat_id]
-        if time_passed < 3:
-            wait_time = int(3 - time_passed)
-            bot.send_message(chat_id, f"⏳ Please wait {wait_time}s before fetching past OTPs again.")
-            return
-    
-    past_otp_fetch_cooldown[chat_id] = now
+def fetch_past_otps(chat_id, number, refresh=False):
+    """Show past OTPs for a number from the local history (panel only on refresh)"""
+    if refresh:
+        now = time.time()
+        if chat_id in past_otp_fetch_cooldown:
+            time_passed = now - past_otp_fetch_cooldown[chat_id]
+            if time_passed < 3:
+                wait_time = int(3 - time_passed)
+                bot.send_message(chat_id, f"⏳ Please wait {wait_time}s before refreshing past OTPs again.")
+                return
+        past_otp_fetch_cooldown[chat_id] = now
     
     try:
-        loading_msg = bot.send_message(chat_id, "⏳ <b>Fetching past OTPs...</b>\n\nThis may take a few seconds.")
+        if refresh:
+            loading_msg = bot.send_message(chat_id, "⏳ <b>Refreshing past OTPs from panel...</b>\n\nThis may take a few seconds.")
+            records = past_otp_snapshot.lookup(number)
+            bot.delete_message(chat_id, loading_msg.message_id)
+            if records is None:
+                bot.send_message(chat_id, "❌ Failed to fetch past OTPs. Try again later.")
+                return
+            cache_past_records(records)
         
         cached_otps = get_cached_past_otps(number, 50)
+        total, senders, otp_count = get_past_otp_summary(number)
         
-        response = requests.get(
-            f"{BASE_URL}/viewstats",
-            params={
-                "token": API_TOKEN,
-                "dt1": "1970-01-01 00:00:00",
-                "dt2": "2099-12-31 23:59:59",
-                "records": 2000
-            },
-            timeout=15
-        )
-        
-        bot.delete_message(chat_id, loading_msg.message_id)
-        
-        if response.status_code != 200:
-            bot.send_message(chat_id, "❌ Failed to fetch past OTPs. Try again later.")
-            return
-        
-        data = response.json()
-        
-        if data.get("status") != "success":
-            bot.send_message(chat_id, "❌ No past OTPs found in API response.")
-            return
-        
-        user_messages_list = []
-        for record in data.get("data", []):
-            record_number = str(record.get("num", "")).lstrip("0").lstrip("+")
-            if record_number == number:
-                user_messages_list.append(record)
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🔄 Refresh from panel", callback_data=f"refresh_past_{number}"))
         
-        if not user_messages_list and not cached_otps:
-            bot.send_message(chat_id, f"📭 <b>No past OTPs found for:</b>\n<code>{number}</code>")
+        if not cached_otps:
+            bot.send_message(chat_id, f"📭 <b>No past OTPs found for:</b>\n<code>{number}</code>",
+                             reply_markup=markup)
             return
         
         country_info, flag = country_from_number(number)
         
         msg_text = f"{flag} <b>Past OTPs for {number}</b>\n"
         msg_text += f"<b>Country:</b> {country_info}\n"
-        msg_text += f"<b>Total Messages Found:</b> {len(user_messages_list)}\n"
+        msg_text += f"<b>Total Messages Found:</b> {total}\n"
         msg_text += "━━━━━━━━━━━━━━━━━━\n\n"
         
-        display_count = min(50, len(user_messages_list))
-        
-        if display_count == 0 and cached_otps:
-            msg_text += "<i>📦 Showing cached data:</i>\n\n"
-            for i, (sender, message, otp, timestamp) in enumerate(cached_otps[:30], 1):
-                otp_display = f"🎯 <code>{html.escape(otp)}</code>" if otp else "❌ No OTP"
-                
-                msg_text += f"<b>{i}. {html.escape(sender)}</b>\n"
-                msg_text += f"   {otp_display}\n"
-                msg_text += f"   🕐 {html.escape(timestamp)}\n"
-                msg_text += f"   📩 {html.escape(message[:80])}\n\n"
-                
-                if len(msg_text) > 3500:
-                    bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
-                    msg_text = ""
-        else:
-            for i, record in enumerate(user_messages_list[:display_count], 1):
-                sender = record.get("cli", "Unknown")
-                message = record.get("message", "")
-                dt = record.get("dt", "")
-                
-                otp = extract_otp(message)
-                otp_display = f"🎯 <code>{html.escape(otp)}</code>" if otp else "❌ No OTP"
-                
-                msg_text += f"<b>{i}. {html.escape(sender)}</b>\n"
-                msg_text += f"   {otp_display}\n"
-                msg_text += f"   🕐 {html.escape(str(dt))}\n"
-                msg_text += f"   📩 {html.escape(message[:100])}\n\n"
-                
-                if len(msg_text) > 3500:
-                    bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
-                    msg_text = ""
+        for i, (sender, message, otp, timestamp) in enumerate(cached_otps, 1):
+            otp_display = f"🎯 <code>{html.escape(otp)}</code>" if otp else "❌ No OTP"
+            
+            msg_text += f"<b>{i}. {html.escape(sender or 'Unknown')}</b>\n"
+            msg_text += f"   {otp_display}\n"
+            msg_text += f"   🕐 {html.escape(str(timestamp))}\n"
+            msg_text += f"   📩 {html.escape((message or '')[:100])}\n\n"
+            
+            # Split message if too long (Telegram limit ~4096 chars)
+            if len(msg_text) > 3500:
+                bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
+                msg_text = ""
         
         if msg_text:
-            if len(user_messages_list) > display_count:
-                msg_text += f"\n<i>Showing {display_count} of {len(user_messages_list)} messages</i>"
+            if total > len(cached_otps):
+                msg_text += f"\n<i>Showing {len(cached_otps)} of {total} messages</i>"
             bot.send_message(chat_id, msg_text, disable_web_page_preview=True)
         
         summary = f"""
 📊 <b>Summary:</b>
 
-✅ Found {len(user_messages_list)} messages
-📱 Service providers: {len(set(r.get('cli', 'Unknown') for r in user_messages_list))}
-🔑 OTPs extracted: {sum(1 for r in user_messages_list if extract_otp(r.get('message', '')))}
+✅ Found {total} messages
+📱 Service providers: {senders}
+🔑 OTPs extracted: {otp_count}
 """
-        bot.send_message(chat_id, summary)
+        bot.send_message(chat_id, summary, reply_markup=markup)
         
     except Exception as e:
         print(f"❌ Error fetching past OTPs: {e}", flush=True)
@@ -1202,6 +1209,16 @@ def handle_callbacks(call):
         bot.answer_callback_query(call.id, "⏳ Fetching past OTPs...")
         fetch_past_otps(chat_id, number)
     
+    elif call.data.startswith("refresh_past_"):
+        number = call.data[13:]
+        assigned_number = get_number_by_chat(chat_id)
+        if assigned_number != number:
+            bot.answer_callback_query(call.id, "❌ This is not your current number!")
+            return
+        
+        bot.answer_callback_query(call.id, "⏳ Refreshing from panel...")
+        fetch_past_otps(chat_id, number, refresh=True)
+    
     elif call.data == "verify_join":
         not_joined = []
         for channel in REQUIRED_CHANNELS:
@@ -1269,6 +1286,23 @@ def other_admin_commands(message):
         else:
             bot.reply_to(message, "Usage: /cleannumbers <name>")
 
+# ==================== HISTORY BACKFILL ====================
+def past_otp_backfill_thread():
+    """Keep past_otps_cache filled from the panel so lookups stay local"""
+    while True:
+        try:
+            viewstats_poller.throttle()  # a 2,000-row snapshot counts against the panel's rate cap
+            records = fetch_past_snapshot()
+            if records is None:
+                viewstats_poller.record_error()
+            if records:
+                added = cache_past_records(records)
+                if added:
+                    print(f"📚 Backfilled {added} past OTPs", flush=True)
+        except Exception as e:
+            print(f"❌ Backfill error: {e}", flush=True)
+        time.sleep(BACKFILL_INTERVAL)
+
 # ==================== CLEANUP THREAD ====================
 def cleanup_thread():
     while True:
@@ -1294,11 +1328,16 @@ if __name__ == "__main__":
     print(f"🚀 OTP Bot v2.0 Starting at {time.strftime('%Y-%m-%d %H:%M:%S')}", flush=True)
     print(f"📊 Initial stats: {len(numbers_by_country)} countries loaded", flush=True)
     
+    exit_on_sigterm()
+    db_writer.start()
+    outbox.replay()
     threading.Thread(target=run_bot, daemon=True, name="BotPoller").start()
     threading.Thread(target=otp_scraper_thread, daemon=True, name="OTPScraper").start()
     threading.Thread(target=group_sender_thread, daemon=True, name="GroupSender").start()
-    threading.Thread(target=personal_sender_thread, daemon=True, name="PersonalSender").start()
+    threading.Thread(target=telegram_api.warm, daemon=True, name="ApiWarmup").start()
+    personal_queue.start(personal_sender_thread, name="PersonalSender")
     threading.Thread(target=cleanup_thread, daemon=True, name="Cleaner").start()
+    threading.Thread(target=past_otp_backfill_thread, daemon=True, name="Backfill").start()
     
     print("✅ All threads started successfully!", flush=True)
     
@@ -5,21 +5,27 @@ import os
 import random
 from flask import Flask, Response
 import threading
-import queue
 import requests
 import re
 import html
 import phonenumbers
-import pycountry
 import time
-import hashlib
 from bs4 import BeautifulSoup
 import logging
 from datetime import datetime
-from collections import deque
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import sqlite3
 from contextlib import contextmanager
+from datatables import DataTablesQuery, SlidingDateWindow, panel_utc_offset, walk_pages
+from poller import AdaptivePoller
+from dedupe import SeenStore
+from records import from_datatables, record_hex, record_id
+from storage import Database, WriteBehind, exit_on_sigterm
+from ratelimit import TelegramLimiter, limit_bot
+from botapi import BotApi, CONNECT_TIMEOUT
+from fanout import FanOut
+from outbox import Outbox
+from subscribers import SubscriberIndex
+from countries import country_table
 
 # ---------------- CONFIG / LOGGING ----------------
 logging.basicConfig(level=logging.INFO)
@@ -35,16 +41,38 @@ USERNAME = os.getenv("USERNAME")
 PASSWORD = os.getenv("PASSWORD") 
 
 bot = telebot.TeleBot(BOT_TOKEN)
+telegram_limiter = TelegramLimiter()
+limit_bot(bot, telegram_limiter)
 
 DATA_FILE = "bot_data.json"
 NUMBERS_DIR = "numbers"
 DB_FILE = "otp_data.db"
+db = Database(DB_FILE, row_factory=sqlite3.Row)
+db_writer = WriteBehind(db)  # Batched otp_records inserts
 
 os.makedirs(NUMBERS_DIR, exist_ok=True)
 
 # API Config
 LOGIN_URL = "http://217.23.5.21/ints/signin"
-XHR_URL = "http://217.23.5.21/ints/agent/res/data_smscdr.php?fdate1=2025-12-10%2000:00:00&fdate2=2026-12-10%2023:59:59&frange=&fclient=&fnum=&fcli=&fgdate=&fgmonth=&fgrange=&fgclient=&fgnumber=&fgcli=&fg=0&sEcho=1&iColumns=9&sColumns=%2C%2C%2C%2C%2C%2C%2C%2C&iDisplayStart=0&iDisplayLength=05&mDataProp_0=0&sSearch_0=&bRegex_0=false&bSearchable_0=true&bSortable_0=true&mDataProp_1=1&sSearch_1=&bRegex_1=false&bSearchable_1=true&bSortable_1=true&mDataProp_2=2&sSearch_2=&bRegex_2=false&bSearchable_2=true&bSortable_2=true&mDataProp_3=3&sSearch_3=&bRegex_3=false&bSearchable_3=true&bSortable_3=true&mDataProp_4=4&sSearch_4=&bRegex_4=false&bSearchable_4=true&bSortable_4=true&mDataProp_5=5&sSearch_5=&bRegex_5=false&bSearchable_5=true&bSortable_5=true&mDataProp_6=6&sSearch_6=&bRegex_6=false&bSearchable_6=true&bSortable_6=true&mDataProp_7=7&sSearch_7=&bRegex_7=false&bSearchable_7=true&bSortable_7=true&mDataProp_8=8&sSearch_8=&bRegex_8=false&bSearchable_8=true&bSortable_8=false&sSearch=&bRegex=false&iSortCol_0=0&sSortDir_0=desc&iSortingCols=1&_=1765341572548" 
+XHR_QUERY = DataTablesQuery(
+    "http://217.23.5.21/ints/agent/res/data_smscdr.php",
+    filters={
+        "frange": "", "fclient": "", "fnum": "", "fcli": "",
+        "fgdate": "", "fgmonth": "", "fgrange": "", "fgclient": "", "fgnumber": "", "fgcli": "",
+        "fg": 0,
+    },
+    columns=9,
+    unsortable=(8,),
+)
+XHR_POLL_LENGTH = 5  # rows per normal poll
+XHR_PAGE_LENGTH = 100  # rows per catch-up page
+XHR_MAX_CATCHUP_ROWS = 2000
+# fdate1 trails a few minutes behind the panel's clock (PANEL_UTC_OFFSET, else ours); fdate2 is open
+XHR_WINDOW = SlidingDateWindow(minutes=10, margin=2, utc_offset=panel_utc_offset())
+XHR_POLLER = AdaptivePoller(min_interval=0.5, max_interval=10)
+XHR_LOOKUP_DAYS = 7  # date range for fnum/fcli lookups
+XHR_LOOKUP_LENGTH = 100
+XHR_LOOKUP_COOLDOWN = 30  # seconds before one chat may look the same number up again
 
 OTP_GROUP_IDS = ["-1002953319148"]
 
@@ -73,21 +101,29 @@ current_country = None
 user_messages = {}
 user_current_country = {}
 temp_uploads = {}
-user_numbers = {}
+past_lookup_cooldown = {}  # (chat_id, number) -> last panel lookup for View Past / Refresh
+subscribers = SubscriberIndex(exclusive=True)  # number -> its latest chat, mirrors user_assignments
 
 MAX_SEEN = 200000
-seen_messages = set()
-seen_order = deque()
+SEEN_FILE = "seen_hashes.bin"
+seen_messages = SeenStore(SEEN_FILE, ttl=86400, max_entries=MAX_SEEN)
 
 # Separate queues for different operations
-group_message_queue = queue.Queue()
-personal_message_queue = queue.Queue()
-otp_processing_queue = queue.Queue()
+outbox = Outbox(db)  # Outbound messages stay on disk until Telegram accepts them
+OUTBOX_BATCH = 20
+GROUP_TTL = 180  # Seconds before a queued group post is shed; the code has likely expired
+PERSONAL_TTL = 600  # DMs are kept longer: the user is waiting for this number's code
+GROUP_BACKLOG = 20  # Waiting posts per group (about a minute of its 20/min budget); older ones are shed
+group_message_queue = outbox.lane("group")
+personal_message_queue = outbox.lane("personal")
 
 # ThreadPool configs
 MAX_WORKERS_GROUP = 8
 MAX_WORKERS_PERSONAL = 10
 SEND_TIMEOUT = 8
+fanout = FanOut(workers=MAX_WORKERS_GROUP, name="Send")  # Shared by every multi-chat send
+# Own keep-alive pool for api.telegram.org: the fan-out workers plus the inline single-chat sends
+telegram_api = BotApi(BOT_TOKEN, pool_size=MAX_WORKERS_GROUP + 2, timeout=(CONNECT_TIMEOUT, SEND_TIMEOUT))
 
 active_users = set()
 REQUIRED_CHANNELS = ["@NomorGo", "@NomorGoNums"]
@@ -95,7 +131,7 @@ REQUIRED_CHANNELS = ["@NomorGo", "@NomorGoNums"]
 # ---------------- SQLITE DATABASE ----------------
 def init_database():
     """Initialize SQLite database with required tables"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = db.connect()
     cursor = conn.cursor()
     
     # OTP records table
@@ -148,36 +184,28 @@ def init_database():
 @contextmanager
 def get_db():
     """Context manager for database connections"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    conn = db.connect()
     try:
         yield conn
     finally:
         conn.close()
 
-def save_otp_to_db(record, hash_id):
-    """Save OTP record to database"""
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR IGNORE INTO otp_records 
-                (hash_id, number, sender, message, otp_code, country, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                hash_id,
-                record.get("num", ""),
-                record.get("cli", ""),
-                record.get("message", ""),
-                record.get("otp", ""),
-                record.get("country", ""),
-                record.get("dt", "")
-            ))
-            conn.commit()
-            return True
-    except Exception as e:
-        logger.error(f"Failed to save OTP to DB: {e}")
-        return False
+def save_otp_to_db(record):
+    """Queue OTP record for the batched database writer"""
+    db_writer.submit('''
+        INSERT OR IGNORE INTO otp_records 
+        (hash_id, number, sender, message, otp_code, country, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        record.hex_id,
+        record.number,
+        record.sender,
+        record.message,
+        record.otp,
+        record.country,
+        record.dt
+    ))
+    return True
 
 def get_past_otps(number, limit=10):
     """Get past OTP records for a number"""
@@ -201,17 +229,28 @@ def save_user_assignment(chat_id, number, country):
     try:
         with get_db() as conn:
             cursor = conn.cursor()
-            # Remove old assignments for this chat_id
-            cursor.execute('DELETE FROM user_assignments WHERE chat_id = ?', (chat_id,))
+            # Remove old assignments for this chat_id, and this number's previous owner
+            cursor.execute('DELETE FROM user_assignments WHERE chat_id = ? OR number = ?', (chat_id, number))
             # Add new assignment
             cursor.execute('''
                 INSERT INTO user_assignments (chat_id, number, country)
                 VALUES (?, ?, ?)
             ''', (chat_id, number, country))
             conn.commit()
+        subscribers.replace_chat(chat_id, [number])
     except Exception as e:
         logger.error(f"Failed to save user assignment: {e}")
 
+def load_subscribers():
+    """Build the in-memory routing index from user_assignments"""
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT number, chat_id FROM user_assignments ORDER BY id')
+            subscribers.load(cursor.fetchall())
+    except Exception as e:
+        logger.error(f"Failed to load subscribers: {e}")
+
 def update_active_user(chat_id, username=None):
     """Update active user record"""
     try:
@@ -252,6 +291,7 @@ def get_all_active_users():
 
 # Initialize database
 init_database()
+load_subscribers()
 
 # ---------------- DATA FUNCTIONS ----------------
 def load_data():
@@ -292,7 +332,10 @@ def index():
 
 @app.route("/health")
 def health():
-    return Response("OK", status=200)
+    healthy = db_writer.alive()
+    return Response(f"{'OK' if healthy else 'DEGRADED'} - {XHR_POLLER.status()} {db_writer.status()} "
+                    f"{telegram_limiter.status()} {fanout.status()} {outbox.status()}",
+                    status=200 if healthy else 503)
 
 @app.route("/stats")
 def stats():
@@ -308,14 +351,22 @@ def _send_single(chat_id, payload):
     payload_local = payload.copy()
     payload_local["chat_id"] = chat_id
     try:
-        r = session.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage", 
-                        data=payload_local, timeout=SEND_TIMEOUT)
-        return chat_id, r.status_code
+        for _ in range(2):
+            telegram_limiter.acquire(chat_id)
+            r = telegram_api.post("sendMessage", data=payload_local)
+            if r.status_code != 429:
+                break
+            retry_after = r.json().get("parameters", {}).get("retry_after", 1)
+            logger.warning(f"⏳ Rate limited on {chat_id}, backing off {retry_after}s")
+            telegram_limiter.backoff(chat_id, retry_after)
+        message_id = r.json().get("result", {}).get("message_id") if r.status_code == 200 else None
+        return chat_id, r.status_code, message_id
     except Exception as e:
         logger.debug(f"Error sending to {chat_id}: {e}")
-        return chat_id, None
+        return chat_id, None, None
 
-def send_to_telegram(msg, chat_ids, kb=None):
+def queue_to_telegram(lane, msg, chat_ids, kb=None, ttl=None):
+    """Persist one outbound message per chat; the sender workers deliver them"""
     payload = {
         "text": msg[:3900],
         "parse_mode": "HTML",
@@ -327,119 +378,87 @@ def send_to_telegram(msg, chat_ids, kb=None):
         except Exception:
             pass
 
-    results = {}
-    if not chat_ids:
-        return results
-    
-    workers = min(MAX_WORKERS_GROUP, max(1, len(chat_ids)))
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        futures = {ex.submit(_send_single, cid, payload): cid for cid in chat_ids}
-        for fut in as_completed(futures):
-            cid = futures[fut]
-            try:
-                _, status = fut.result()
-                results[cid] = status
-            except Exception as e:
-                logger.debug(f"Send exception for {cid}: {e}")
-                results[cid] = None
+    fetch_time = time.time()
+    deadline = fetch_time + ttl if ttl else None
+    for chat_id in chat_ids:
+        lane.put(chat_id, payload, deadline=deadline, fetch_time=fetch_time)
+
+def _should_retry(status):
+    return status is None or status == 429 or status >= 500
+
+def _send_in_order(items, on_sent=None):
+    """Send one chat's items oldest first, stopping at the first one to retry"""
+    results = []
+    for item in items:
+        _, status, message_id = _send_single(item.chat_id, item.payload)
+        if status == 200 and on_sent:
+            on_sent(item.chat_id, message_id)
+        results.append((item.id, status))
+        if _should_retry(status):
+            break
     return results
 
-# ---------------- MESSAGE WORKERS ----------------
-def group_sender_worker():
-    """Dedicated worker for group messages"""
-    logger.info("🚀 Group sender worker started")
+def drain_outbox(lane, name, backlog=None, on_sent=None):
+    """Claim, send and acknowledge one outbox lane; chats fan out in parallel
+
+    ``backlog()`` gives the lane's waiting-row limit, re-read on every pass.
+    """
+    logger.info(f"🚀 {name} sender worker started")
     while True:
         try:
-            item = group_message_queue.get()
-            msg, chat_ids, kb = item
-            send_to_telegram(msg, chat_ids, kb)
+            if backlog:
+                lane.shed_backlog(backlog())
+            items = lane.claim(OUTBOX_BATCH)
+            now = time.time()
+            lane.drop([item.id for item in items if item.expired(now)], "expired")
+            items = [item for item in items if not item.expired(now)]
+            by_chat = {}
+            for item in items:
+                by_chat.setdefault(item.chat_id, []).append(item)
+            settled = set()
+            for results in fanout.map(lambda cid: _send_in_order(by_chat[cid], on_sent), by_chat).values():
+                for item_id, status in results or ():
+                    if _should_retry(status):
+                        continue
+                    settled.add(item_id)
+                    if status != 200:
+                        logger.warning(f"Telegram rejected outbound message {item_id}: {status}")
+            lane.ack(settled)
+            lane.retry([item.id for item in items if item.id not in settled])
         except Exception as e:
-            logger.error(f"Group sender error: {e}")
-        finally:
-            group_message_queue.task_done()
-        time.sleep(0.03)
+            logger.error(f"{name} sender error: {e}")
+            time.sleep(1)
+
+# ---------------- MESSAGE WORKERS ----------------
+def group_sender_worker():
+    """Dedicated worker for group messages"""
+    drain_outbox(group_message_queue, "Group", backlog=lambda: GROUP_BACKLOG * len(OTP_GROUP_IDS))
 
 def personal_sender_worker():
     """Dedicated worker for personal messages"""
-    logger.info("🚀 Personal sender worker started")
-    while True:
-        try:
-            item = personal_message_queue.get()
-            msg, chat_id = item
-            send_to_telegram(msg, [chat_id])
-        except Exception as e:
-            logger.error(f"Personal sender error: {e}")
-        finally:
-            personal_message_queue.task_done()
-        time.sleep(0.02)
-
-def otp_processor_worker():
-    """Dedicated worker for processing OTP records"""
-    logger.info("🚀 OTP processor worker started")
-    while True:
-        try:
-            record = otp_processing_queue.get()
-            
-            # Save to database
-            hash_id = record.get("hash_id")
-            save_otp_to_db(record, hash_id)
-            
-            # Format and queue group message
-            msg_group, number = format_message(record, personal=False)
-            keyboard = types.InlineKeyboardMarkup()
-            keyboard.add(types.InlineKeyboardButton("📱 Channel", url=CHANNEL_LINK))
-            keyboard.add(types.InlineKeyboardButton("🚀 Panel", url=f"https://t.me/{DEVELOPER_ID.lstrip('@')}"))
-            group_message_queue.put((msg_group, OTP_GROUP_IDS, keyboard))
-            
-            # Check for personal assignment
-            chat_id = user_numbers.get(number)
-            if chat_id:
-                msg_personal, _ = format_message(record, personal=True)
-                personal_message_queue.put((msg_personal, chat_id))
-                
-        except Exception as e:
-            logger.error(f"OTP processor error: {e}")
-        finally:
-            otp_processing_queue.task_done()
-        time.sleep(0.01)
+    drain_outbox(personal_message_queue, "Personal")
 
-# ---------------- HELPER FUNCTIONS ----------------
-EXTRA_CODES = {"Kosovo": "XK"}
+def process_record(record):
+    """Save an OTP record and put its group post and DMs in the outbox"""
+    # Save to database
+    save_otp_to_db(record)
+    
+    # Format and queue group message
+    msg_group, number = format_message(record, personal=False)
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton("📱 Channel", url=CHANNEL_LINK))
+    keyboard.add(types.InlineKeyboardButton("🚀 Panel", url=f"https://t.me/{DEVELOPER_ID.lstrip('@')}"))
+    queue_to_telegram(group_message_queue, msg_group, OTP_GROUP_IDS, keyboard, ttl=GROUP_TTL)
+    
+    # Check for personal assignment
+    for chat_id in subscribers.chats_for(number):
+        msg_personal, _ = format_message(record, personal=True)
+        queue_to_telegram(personal_message_queue, msg_personal, [chat_id], ttl=PERSONAL_TTL)
 
+# ---------------- HELPER FUNCTIONS ----------------
 def country_to_flag(country_name: str) -> str:
-    code = EXTRA_CODES.get(country_name)
-    if not code:
-        try:
-            country = pycountry.countries.lookup(country_name)
-            code = country.alpha_2
-        except LookupError:
-            return ""
-    return "".join(chr(127397 + ord(c)) for c in code.upper())
-
-def extract_otp(message: str) -> str | None:
-    text = message.strip()
-    # Look for explicit keywords near digits
-    m = re.search(r"(?:otp|code|pin|password|verification|verif)[^\d]{0,8}([0-9][0-9\-\s]{2,10}[0-9])", text, re.I)
-    if m:
-        cand = re.sub(r"\D", "", m.group(1))
-        if 3 <= len(cand) <= 8 and not (1900 <= int(cand) <= 2099):
-            return cand
-
-    # Reverse pattern
-    m2 = re.search(r"([0-9][0-9\-\s]{2,10}[0-9])[^\w]{0,8}(?:otp|code|pin|password|verification|verif)", text, re.I)
-    if m2:
-        cand = re.sub(r"\D", "", m2.group(1))
-        if 3 <= len(cand) <= 8 and not (1900 <= int(cand) <= 2099):
-            return cand
-
-    # Generic
-    generic = re.findall(r"\b[0-9][0-9\-\s]{2,7}[0-9]\b", text)
-    for g in generic:
-        cand = re.sub(r"\D", "", g)
-        if 3 <= len(cand) <= 8 and not (1900 <= int(cand) <= 2099):
-            return cand
-
-    return None
+    meta = country_table.get(country_name)
+    return meta.flag if meta else ""
 
 def mask_number(number: str) -> str:
     if len(number) <= 6:
@@ -448,13 +467,10 @@ def mask_number(number: str) -> str:
     return number[:mid-1] + "***" + number[mid+2:]
 
 def format_message(record, personal=False):
-    number = record.get("num") or "Unknown"
-    sender = record.get("cli") or "Unknown"
-    message = record.get("message") or ""
-    dt = record.get("dt") or ""
-    country = record.get("country") or "Unknown"
-    flag = country_to_flag(country)
-    otp = record.get("otp") or extract_otp(message)
+    number = record.number or "Unknown"
+    sender, message = record.sender, record.message
+    dt, otp = record.dt, record.otp
+    country, flag = record.country or "Unknown", record.flag
     otp_line = f"<b>OTP:</b> <code>{html.escape(otp)}</code>\n" if otp else ""
     
     if personal:
@@ -525,6 +541,79 @@ def login():
     logger.info("✅ Logged in successfully.")
     return True
 
+def is_valid_row(row):
+    return isinstance(row[0], str) and ":" in row[0]
+
+def row_hash(row):
+    return record_hex(record_id(row[2], row[0], row[5]))
+
+def is_row_seen(row):
+    return is_valid_row(row) and row_hash(row) in seen_messages
+
+def row_to_record(row):
+    return from_datatables(row, country=row[1].split()[0])
+
+def fetch_xhr_page(start, length, dates):
+    """Fetch one page of CDR rows within the ``dates`` window, newest first"""
+    res = session.get(XHR_QUERY.url, params=XHR_QUERY.params(start, length, **dates),
+                      headers=AJAX_HEADERS, timeout=15)
+    res.raise_for_status()
+    return res.json().get("aaData", [])
+
+def lookup_cdrs(number="", service=""):
+    """Ask the panel for one number's (fnum) or one service's (fcli) recent CDRs"""
+    filters = XHR_WINDOW.history(XHR_LOOKUP_DAYS)
+    filters.update({"fnum": number, "fcli": service})
+    XHR_POLLER.throttle()  # lookups count against the same per-panel rate cap as the polls
+    try:
+        res = session.get(XHR_QUERY.url, params=XHR_QUERY.params(0, XHR_LOOKUP_LENGTH, **filters),
+                          headers=AJAX_HEADERS, timeout=15)
+        res.raise_for_status()
+    except Exception:
+        XHR_POLLER.record_error()
+        raise
+    return [row for row in res.json().get("aaData", []) if is_valid_row(row)]
+
+def refresh_history(number="", service=""):
+    """Store a targeted lookup in otp_records without re-sending anything, returns the records"""
+    records = []
+    for row in lookup_cdrs(number, service):
+        try:
+            record = row_to_record(row)
+        except Exception as e:
+            logger.debug(f"Row parse error: {e}")
+            continue
+        save_otp_to_db(record)
+        records.append(record)
+    db_writer.flush()
+    return records
+
+def process_rows(rows):
+    """Dedupe a page of CDR rows, queue the new ones and return how many"""
+    queued = 0
+    for row in rows:
+        if not is_valid_row(row):
+            continue
+        try:
+            hash_id = row_hash(row)
+            if hash_id in seen_messages:
+                continue
+            record = row_to_record(row)
+        except Exception as e:
+            logger.debug(f"Row parse error: {e}")
+            continue
+        try:
+            process_record(record)
+        except Exception as e:
+            # Left unseen, so the next poll picks the row up again
+            logger.error(f"OTP processing error, will retry next poll: {e}")
+            continue
+        # Seen only once its messages are in the outbox
+        seen_messages.add(hash_id)
+        queued += 1
+        logger.info(f"📱 New OTP: {record.number} | {record.sender} | {record.otp or 'N/A'}")
+    return queued
+
 def main_loop():
     """Main OTP fetching loop"""
     logger.info("🚀 OTP Monitor Started...")
@@ -533,65 +622,33 @@ def main_loop():
         return
 
     while True:
+        XHR_POLLER.wait()
+        # Until something has been processed there is no boundary to page
+        # back to, so the first poll only takes the newest page.
+        is_known = is_row_seen if seen_messages else (lambda row: True)
+        polled_at = time.time()
+        dates = XHR_WINDOW.filters(polled_at)
+        new_rows = 0
         try:
-            res = session.get(XHR_URL, headers=AJAX_HEADERS, timeout=15)
-            try:
-                data = res.json()
-            except Exception as e:
-                logger.debug(f"Invalid JSON from XHR: {e}")
-                time.sleep(1.5)
-                continue
-
-            otps = data.get("aaData", [])
-            otps = [row for row in otps if isinstance(row[0], str) and ":" in row[0]]
-
-            for row in otps:
-                try:
-                    time_ = row[0]
-                    country = row[1].split()[0]
-                    number = row[2]
-                    sender = row[3]
-                    message = row[5]
-
-                    hash_id = hashlib.md5((str(number) + str(time_) + str(message)).encode()).hexdigest()
-                    if hash_id in seen_messages:
-                        continue
-
-                    seen_messages.add(hash_id)
-                    seen_order.append(hash_id)
-                    if len(seen_order) > MAX_SEEN:
-                        old = seen_order.popleft()
-                        seen_messages.discard(old)
-
-                    otp_code = extract_otp(message)
-                    record = {
-                        "hash_id": hash_id,
-                        "dt": time_,
-                        "country": country,
-                        "num": number,
-                        "cli": sender,
-                        "message": message,
-                        "otp": otp_code
-                    }
-
-                    # Queue for processing
-                    otp_processing_queue.put(record)
-                    logger.info(f"📱 New OTP: {number} | {sender} | {otp_code or 'N/A'}")
-
-                except Exception as e:
-                    logger.debug(f"Row parse error: {e}")
-
+            fetch_page = lambda start, length: fetch_xhr_page(start, length, dates)
+            for rows in walk_pages(fetch_page, is_known, XHR_POLL_LENGTH,
+                                   XHR_PAGE_LENGTH, XHR_MAX_CATCHUP_ROWS, XHR_POLLER.throttle):
+                if rows:
+                    XHR_WINDOW.observe(rows[0][0])
+                new_rows += process_rows(rows)
+            XHR_WINDOW.mark_ok(polled_at)
+            XHR_POLLER.record(new_rows)
+            seen_messages.maybe_save()
+        except ValueError as e:
+            logger.debug(f"Invalid JSON from XHR: {e}")
+            XHR_POLLER.record_error()
         except Exception as e:
             logger.error(f"❌ Error fetching OTPs: {e}")
-            try:
-                if res is not None and getattr(res, 'status_code', None) == 401:
-                    logger.info("Attempting to re-login...")
-                    if not login():
-                        logger.error("❌ Re-login failed.")
-            except Exception:
-                pass
-
-        time.sleep(1.0)
+            XHR_POLLER.record_error()
+            if getattr(getattr(e, "response", None), "status_code", None) == 401:
+                logger.info("Attempting to re-login...")
+                if not login():
+                    logger.error("❌ Re-login failed.")
 
 # ---------------- USER BOT FUNCTIONS ----------------
 def send_random_number(chat_id, country=None, edit=False):
@@ -608,7 +665,6 @@ def send_random_number(chat_id, country=None, edit=False):
     
     number = random.choice(numbers)
     user_current_country[chat_id] = country
-    user_numbers[number] = chat_id
     
     # Save assignment to database
     save_user_assignment(chat_id, number, country)
@@ -756,13 +812,43 @@ def handle_country_selection(call):
     send_random_number(chat_id, country, edit=True)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("view_past_"))
+def past_lookup_wait(chat_id, number):
+    """Seconds until this chat may look ``number`` up on the panel again; 0 starts a new cooldown"""
+    now = time.time()
+    key = (chat_id, number)
+    if key in past_lookup_cooldown:
+        time_passed = now - past_lookup_cooldown[key]
+        if time_passed < XHR_LOOKUP_COOLDOWN:
+            return int(XHR_LOOKUP_COOLDOWN - time_passed) + 1
+    if len(past_lookup_cooldown) > 1000:
+        for stale in [k for k, t in past_lookup_cooldown.items() if now - t >= XHR_LOOKUP_COOLDOWN]:
+            del past_lookup_cooldown[stale]
+    past_lookup_cooldown[key] = now
+    return 0
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(("view_past_", "refresh_past_")))
 def handle_view_past(call):
     """Handle viewing past OTPs"""
     chat_id = call.message.chat.id
-    number = call.data[10:]  # Remove "view_past_" prefix
+    refresh = call.data.startswith("refresh_past_")
+    number = call.data[13:] if refresh else call.data[10:]  # Remove the prefix
     
-    past_otps = get_past_otps(number, limit=10)
+    past_otps = [] if refresh else get_past_otps(number, limit=10)
+    if not past_otps:
+        wait = past_lookup_wait(chat_id, number)
+        if wait:
+            # Cooling down: serve what is stored instead of asking the panel again
+            past_otps = get_past_otps(number, limit=10)
+            if not past_otps:
+                bot.answer_callback_query(call.id, f"⏳ Please wait {wait}s before checking the panel again", show_alert=True)
+                return
+        else:
+            # Nothing stored yet (or an explicit refresh): ask the panel for this number only
+            try:
+                refresh_history(number=number)
+            except Exception as e:
+                logger.error(f"Number lookup failed: {e}")
+            past_otps = get_past_otps(number, limit=10)
     
     if not past_otps:
         bot.answer_callback_query(call.id, "❌ No past OTPs found for this number", show_alert=True)
@@ -785,8 +871,11 @@ def handle_view_past(call):
     
     text += f"<i>Showing last {len(past_otps)} OTPs</i>"
     
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔄 Refresh", callback_data=f"refresh_past_{number}"))
+    
     try:
-        bot.send_message(chat_id, text, parse_mode="HTML")
+        bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=markup)
         bot.answer_callback_query(call.id, "✅ Past OTPs sent!")
     except Exception as e:
         logger.error(f"Failed to send past OTPs: {e}")
@@ -840,7 +929,6 @@ def broadcast_message(message):
             success_count += 1
         except Exception:
             fail_count += 1
-        time.sleep(0.05)
 
     bot.reply_to(message, f"✅ Broadcast sent!\n✅ Success: {success_count}\n❌ Failed: {fail_count}")
 
@@ -886,7 +974,6 @@ def show_stats(message):
             # Queue sizes
             group_queue_size = group_message_queue.qsize()
             personal_queue_size = personal_message_queue.qsize()
-            processing_queue_size = otp_processing_queue.qsize()
             
             stats_text = (
                 f"📊 <b>Bot Statistics</b>\n\n"
@@ -897,8 +984,7 @@ def show_stats(message):
                 f"   • Active: {active_count}\n\n"
                 f"⚙️ <b>Queue Status:</b>\n"
                 f"   • Group Queue: {group_queue_size}\n"
-                f"   • Personal Queue: {personal_queue_size}\n"
-                f"   • Processing Queue: {processing_queue_size}\n\n"
+                f"   • Personal Queue: {personal_queue_size}\n\n"
                 f"🌍 <b>Countries:</b> {len(numbers_by_country)}\n"
                 f"📞 <b>Total Numbers:</b> {sum(len(v) for v in numbers_by_country.values())}"
             )
@@ -1063,6 +1149,32 @@ def list_countries(message):
         text += f"• {country}: {len(nums)} numbers\n"
     bot.reply_to(message, text)
 
+@bot.message_handler(commands=["lookup"])
+def lookup_command(message):
+    if message.from_user.id != ADMIN_ID:
+        return bot.reply_to(message, "❌ You are not the admin.")
+    args = message.text.split(maxsplit=2)
+    if len(args) == 3 and args[1].lower() == "cli":
+        number, service = "", args[2]
+    elif len(args) == 2:
+        number, service = args[1], ""
+    else:
+        return bot.reply_to(message, "Usage: /lookup &lt;number&gt; or /lookup cli &lt;service&gt;", parse_mode="HTML")
+    try:
+        records = refresh_history(number=number, service=service)
+    except Exception as e:
+        logger.error(f"Lookup failed: {e}")
+        return bot.reply_to(message, "❌ Panel lookup failed.")
+    if not records:
+        return bot.reply_to(message, "📭 No CDRs found.")
+    text = f"🔎 <b>{len(records)} CDRs for {html.escape(number or service)}</b>\n\n"
+    for record in records[:10]:
+        text += (
+            f"🕐 {html.escape(record.dt)} | <code>{html.escape(record.number)}</code>\n"
+            f"   {html.escape(record.sender)}: <code>{html.escape(record.otp or 'N/A')}</code>\n"
+        )
+    bot.reply_to(message, text, parse_mode="HTML")
+
 @bot.message_handler(commands=["adminhelp"])
 def admin_help(message):
     if message.from_user.id != ADMIN_ID:
@@ -1084,6 +1196,10 @@ def admin_help(message):
 📢 <b>Communication:</b>
 • /broadcast - Send message to all users
 
+🔎 <b>Panel Lookup:</b>
+• /lookup &lt;number&gt; - Fetch CDRs for one number
+• /lookup cli &lt;service&gt; - Fetch CDRs for one service
+
 ❓ /adminhelp - Show this help menu
 """
     bot.reply_to(message, help_text, parse_mode="HTML")
@@ -1116,13 +1232,16 @@ def run_bot():
 if __name__ == "__main__":
     logger.info("🚀 Starting all services...")
     
+    exit_on_sigterm()
+    db_writer.start()
+    outbox.replay()
     # Start Flask
     threading.Thread(target=run_flask, daemon=True, name="Flask").start()
     
     # Start message workers
+    threading.Thread(target=telegram_api.warm, daemon=True, name="ApiWarmup").start()
     threading.Thread(target=group_sender_worker, daemon=True, name="GroupSender").start()
     threading.Thread(target=personal_sender_worker, daemon=True, name="PersonalSender").start()
-    threading.Thread(target=otp_processor_worker, daemon=True, name="OTPProcessor").start()
     
     # Start OTP fetcher
     threading.Thread(target=main_loop, daemon=True, name="OTPFetcher").start()
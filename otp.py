@@ -0,0 +1,74 @@
+"""OTP extraction shared by every bot.
+
+There were two extractors.  app.py, kontek.py and maitt.py ran three
+precompiled regexes in turn.  The DataTables bots ran inline
+``re.search`` / ``re.findall`` patterns and an ``re.sub`` per candidate.
+``OTP_PATTERN`` is one compiled alternation with three branches:
+
+* ``after``:  a keyword followed by the code ("Your code is 123-456")
+* ``before``: a code followed by a keyword ("482913 is your WhatsApp code").
+  The keyword is a lookahead, so it stays available to the ``after`` branch.
+* ``bare``:   any other standalone 3-8 digit run
+
+A single ``finditer`` pass collects every candidate.  ``rank`` scores them
+(branch weight, then length and year/amount penalties), and the best one
+wins.  ``otp_corpus.jsonl`` and ``bench_otp.py`` measure speed and accuracy.
+"""
+import re
+
+KEYWORDS = (
+    r"otp|one[- ]time|pass ?code|password|pin|code|c[oó]digo|kode|kod|"
+    r"verification|verify|verif|auth|login|token|код|رمز|验证码"
+)
+# 3-8 digits, optionally grouped as 123-456 / 123 456, not part of a longer
+# number or of an alphanumeric token such as an app hash ("abcDEF123")
+_CODE = r"(?<![\w+])(?:\d{3} \d{3}|\d(?:-?\d){2,7})(?![\w])"
+
+# Every branch starts with a digit or a keyword's first letter; checking that
+# one character first lets the scan skip most positions cheaply.
+_FIRST = "".join(sorted({alt[0] for alt in KEYWORDS.split("|")}))
+
+# Matched against lowercased text: re.I on the keyword alternation is ~5x slower
+OTP_PATTERN = re.compile(
+    rf"(?=[\d{_FIRST}])(?:"
+    rf"(?:{KEYWORDS})[^\d\n]{{0,16}}?(?P<after>{_CODE})"
+    rf"|(?P<before>{_CODE})(?=[^\d\n]{{0,30}}?(?:{KEYWORDS}))"
+    rf"|(?P<bare>{_CODE}))"
+)
+UNICODE_CLEAN = re.compile(r"[\u200e\u200f\u202a-\u202e\u2066-\u2069]")
+_MONEY = re.compile(r"(?:[$€£₹₦]|rs\.?|usd|eur|inr|ngn)\s*$")
+
+BRANCH_WEIGHT = {"after": 30, "before": 20, "bare": 10}
+
+
+def _scan(message):
+    text = UNICODE_CLEAN.sub("", message or "").lower()
+    for match in OTP_PATTERN.finditer(text):
+        branch = match.lastgroup
+        code = match.group(branch).replace("-", "").replace(" ", "")
+        start = match.start(branch)
+        yield rank(branch, code, text, start), -start, code
+
+
+def candidates(message):
+    """``(score, position, code)`` for every code-like token, best first."""
+    return [(score, -neg_start, code) for score, neg_start, code in sorted(_scan(message), reverse=True)]
+
+
+def rank(branch, code, text, start):
+    score = BRANCH_WEIGHT[branch]
+    if 4 <= len(code) <= 8:
+        score += 3
+    if len(code) == 6:
+        score += 1
+    if len(code) == 4 and 1900 <= int(code) <= 2099:
+        score -= 15  # a year, not a code
+    if _MONEY.search(text[max(0, start - 5):start]):
+        score -= 15  # an amount
+    return score
+
+
+def extract_otp(message):
+    """Best OTP candidate in ``message``, or None."""
+    best = max(_scan(message), default=None)  # highest score, earliest on ties
+    return best[2] if best and best[0] > 0 else None
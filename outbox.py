@@ -0,0 +1,268 @@
+"""Durable outbound message queue in SQLite.
+
+The senders fed from in-memory ``Queue``s.  A full queue dropped the OTP
+with a print, and whatever was still queued vanished on restart.
+``Outbox`` keeps every outbound ``sendMessage`` payload in the bot's
+database until the sender acknowledges it:
+
+* ``put`` commits the payload before returning.  The scrapers mark a record
+  seen, and move their high-water mark past it, only after its messages are
+  on disk, so a failed write is retried on the next poll.
+* ``claim`` leases a batch of a lane's oldest available rows.  A row whose
+  lease runs out without an ``ack`` (a worker crashed mid-batch) becomes
+  claimable again.
+* ``ack`` deletes delivered rows.  ``retry`` puts rows back with an
+  exponential delay.  After ``max_attempts`` a row moves to the
+  ``dead:<lane>`` lane and is counted in ``status()`` instead of vanishing.
+* ``replay`` (at startup) releases every lease, so anything unacknowledged
+  from the previous run goes out again.
+* A row may carry a ``deadline`` (an OTP is useless once it has expired).
+  ``claim`` sheds rows past their deadline instead of sending them, and
+  ``shed_backlog`` trims a lane to its newest rows under load.  Every shed
+  row is counted per lane kind and reason in ``shed``.
+
+Delivery is at least once: a crash between ``sendMessage`` and ``ack``
+sends that message twice.  A lane has a single consumer, which claims rows
+in insertion order.  A chat's row is not claimed while an earlier row for
+the same chat is still held back (retrying or leased), so a retry never
+lets a later OTP overtake an earlier one.
+"""
+import json
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+DEAD_PREFIX = "dead:"
+WAIT_SLICE = 1.0  # Re-check for retried rows whose delay ran out at least this often
+
+
+class OutboxItem(namedtuple("OutboxItem", "id lane chat_id payload meta attempts deadline")):
+    __slots__ = ()
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now or time.time()) > self.deadline
+
+
+def lane_kind(lane):
+    """Counter key for a lane: shard lanes "dm0".."dm15" all count as "dm"."""
+    return re.sub(r"\d+$", "", lane)
+
+
+class Outbox:
+    """Leased, acknowledged message queue stored in one SQLite table."""
+
+    def __init__(self, db, table="outbox", lease=120, retry_delay=5, max_retry_delay=300, max_attempts=20):
+        self.db = db
+        self.table = table
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self._cond = threading.Condition()
+        self._claim_lock = threading.Lock()
+        self._puts = 0
+        self.delivered = 0
+        self.retried = 0
+        self.shed = Counter()  # (lane kind, reason) -> messages not sent
+        self._create()
+
+    def _create(self):
+        conn = self.db.connect()
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS {self.table}
+                         (id INTEGER PRIMARY KEY AUTOINCREMENT, lane TEXT NOT NULL, chat_id,
+                          payload TEXT NOT NULL, meta TEXT, created REAL,
+                          available_at REAL DEFAULT 0, attempts INTEGER DEFAULT 0, deadline REAL)''')
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({self.table})")}
+        if "deadline" not in columns:
+            conn.execute(f"ALTER TABLE {self.table} ADD COLUMN deadline REAL")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_lane ON {self.table}(lane, available_at, id)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_chat ON {self.table}(lane, chat_id, id)")
+        conn.commit()
+        conn.close()
+
+    def lane(self, name):
+        return OutboxLane(self, name)
+
+    def put(self, lane, chat_id, payload, deadline=None, **meta):
+        """Store one message durably; returns its row id."""
+        conn = self.db.connect()
+        cur = conn.execute(
+            f"INSERT INTO {self.table} (lane, chat_id, payload, meta, created, deadline) "
+            f"VALUES (?, ?, ?, ?, ?, ?)",
+            (lane, chat_id, json.dumps(payload), json.dumps(meta), time.time(), deadline),
+        )
+        conn.commit()
+        conn.close()
+        with self._cond:
+            self._puts += 1
+            self._cond.notify_all()
+        return cur.lastrowid
+
+    def _count_shed(self, lane, reason, count):
+        if count > 0:
+            self.shed[lane_kind(lane), reason] += count
+            print(f"🗑️ Shed {count} {reason} message(s) from {lane}", flush=True)
+
+    def _claim(self, lane, limit):
+        now = time.time()
+        with self._claim_lock:
+            conn = self.db.connect()
+            expired = conn.execute(
+                f"DELETE FROM {self.table} WHERE lane = ? AND deadline < ? AND available_at <= ?",
+                (lane, now, now),
+            ).rowcount
+            rows = conn.execute(
+                f"SELECT id, chat_id, payload, meta, attempts, deadline FROM {self.table} AS o "
+                f"WHERE lane = ? AND available_at <= ? AND NOT EXISTS "
+                f"(SELECT 1 FROM {self.table} AS e WHERE e.lane = o.lane AND e.chat_id IS o.chat_id "
+                f"AND e.id < o.id AND e.available_at > ?) "
+                f"ORDER BY id LIMIT ?",
+                (lane, now, now, limit),
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    f"UPDATE {self.table} SET available_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now + self.lease, row[0]) for row in rows],
+                )
+            conn.commit()
+            conn.close()
+        self._count_shed(lane, "expired", expired)
+        return [OutboxItem(row[0], lane, row[1], json.loads(row[2]), json.loads(row[3] or "{}"), row[4] + 1, row[5])
+                for row in rows]
+
+    def claim(self, lane, limit=20, timeout=5.0):
+        """Lease up to ``limit`` rows of ``lane``; waits up to ``timeout`` for one."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                seen = self._puts
+            items = self._claim(lane, limit)
+            remaining = deadline - time.monotonic()
+            if items or remaining <= 0:
+                return items
+            with self._cond:
+                if self._puts == seen:
+                    self._cond.wait(min(remaining, WAIT_SLICE))
+
+    def ack(self, ids):
+        """Delete delivered (or permanently rejected) rows."""
+        ids = list(ids)
+        if not ids:
+            return
+        conn = self.db.connect()
+        conn.executemany(f"DELETE FROM {self.table} WHERE id = ?", [(i,) for i in ids])
+        conn.commit()
+        conn.close()
+        self.delivered += len(ids)
+
+    def retry(self, ids, delay=None):
+        """Make rows claimable again after ``delay`` (default: exponential per attempt)."""
+        ids = list(ids)
+        if not ids:
+            return
+        now = time.time()
+        conn = self.db.connect()
+        if delay is None:
+            conn.executemany(
+                f"UPDATE {self.table} SET available_at = ? + min(?, ? * (1 << min(attempts - 1, 16))) WHERE id = ?",
+                [(now, self.max_retry_delay, self.retry_delay, i) for i in ids],
+            )
+        else:
+            conn.executemany(f"UPDATE {self.table} SET available_at = ? WHERE id = ?",
+                             [(now + delay, i) for i in ids])
+        dead = conn.executemany(
+            f"UPDATE {self.table} SET lane = ? || lane WHERE id = ? AND attempts >= ?",
+            [(DEAD_PREFIX, i, self.max_attempts) for i in ids],
+        ).rowcount
+        conn.commit()
+        conn.close()
+        self.retried += len(ids)
+        if dead > 0:
+            print(f"☠️ {dead} outbound message(s) gave up after {self.max_attempts} attempts", flush=True)
+
+    def drop(self, lane, ids, reason):
+        """Delete rows of ``lane`` that will not be sent, counting them under ``reason``."""
+        ids = list(ids)
+        if not ids:
+            return
+        conn = self.db.connect()
+        count = conn.executemany(f"DELETE FROM {self.table} WHERE id = ?", [(i,) for i in ids]).rowcount
+        conn.commit()
+        conn.close()
+        self._count_shed(lane, reason, count)
+
+    def shed_backlog(self, lane, keep):
+        """Drop all but the newest ``keep`` waiting rows of ``lane``."""
+        now = time.time()
+        conn = self.db.connect()
+        count = conn.execute(
+            f"DELETE FROM {self.table} WHERE lane = ? AND available_at <= ? AND id NOT IN "
+            f"(SELECT id FROM {self.table} WHERE lane = ? ORDER BY id DESC LIMIT ?)",
+            (lane, now, lane, keep),
+        ).rowcount
+        conn.commit()
+        conn.close()
+        self._count_shed(lane, "backlog", count)
+        return count
+
+    def replay(self):
+        """Release every lease; returns how many messages are waiting."""
+        conn = self.db.connect()
+        conn.execute(f"UPDATE {self.table} SET available_at = 0 WHERE lane NOT LIKE ? AND available_at > 0",
+                     (DEAD_PREFIX + "%",))
+        conn.commit()
+        pending = self.depth()
+        conn.close()
+        if pending:
+            print(f"📬 Replaying {pending} unacknowledged outbound message(s)", flush=True)
+        return pending
+
+    def depth(self, lane=None):
+        """Rows waiting or in flight in ``lane`` (all live lanes when None)."""
+        conn = self.db.connect()
+        if lane is None:
+            count = conn.execute(f"SELECT COUNT(*) FROM {self.table} WHERE lane NOT LIKE ?",
+                                 (DEAD_PREFIX + "%",)).fetchone()[0]
+        else:
+            count = conn.execute(f"SELECT COUNT(*) FROM {self.table} WHERE lane = ?", (lane,)).fetchone()[0]
+        conn.close()
+        return count
+
+    def status(self):
+        conn = self.db.connect()
+        dead = conn.execute(f"SELECT COUNT(*) FROM {self.table} WHERE lane LIKE ?",
+                            (DEAD_PREFIX + "%",)).fetchone()[0]
+        conn.close()
+        shed = ",".join(f"{kind}/{reason}:{count}" for (kind, reason), count in sorted(self.shed.items()))
+        return (f"Outbox: pending={self.depth()} delivered={self.delivered} "
+                f"retried={self.retried} dead={dead} shed={shed or 0}")
+
+
+class OutboxLane:
+    """One named lane of an ``Outbox``, with a queue-like surface."""
+
+    def __init__(self, outbox, name):
+        self.outbox = outbox
+        self.name = name
+
+    def put(self, chat_id, payload, deadline=None, **meta):
+        return self.outbox.put(self.name, chat_id, payload, deadline, **meta)
+
+    def claim(self, limit=20, timeout=5.0):
+        return self.outbox.claim(self.name, limit, timeout)
+
+    def ack(self, ids):
+        self.outbox.ack(ids)
+
+    def retry(self, ids, delay=None):
+        self.outbox.retry(ids, delay)
+
+    def drop(self, ids, reason):
+        self.outbox.drop(self.name, ids, reason)
+
+    def shed_backlog(self, keep):
+        return self.outbox.shed_backlog(self.name, keep)
+
+    def qsize(self):
+        return self.outbox.depth(self.name)
@@ -0,0 +1,69 @@
+"""Adaptive poll interval shared by the upstream fetch loops.
+
+Every bot used to sleep a fixed amount between polls (0.3s, 1s or 3s), which
+is too slow during an OTP burst and wasteful overnight.  ``AdaptivePoller``
+drops straight to ``min_interval`` while polls keep returning new records,
+stretches the interval while the feed is idle and backs off harder on errors.
+``min_interval`` doubles as the per-panel rate cap: ``wait()`` never starts
+two polls closer together than that.  Extra requests to the same panel
+(catch-up pages, one-off lookups) go through ``throttle()``, so they share
+the cap and the error backoff instead of adding load on top of the polls.
+"""
+import threading
+import time
+
+
+class AdaptivePoller:
+    """Poll interval that follows the traffic of one upstream panel."""
+
+    def __init__(self, min_interval, max_interval, idle_growth=1.5,
+                 error_backoff=2.0, max_error_interval=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_growth = idle_growth
+        self.error_backoff = error_backoff
+        self.max_error_interval = max_error_interval or max_interval * 2
+        self.interval = min_interval
+        self.errors = 0
+        self._last_start = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Sleep until the next poll is due, then mark it as started."""
+        self._wait_for(extra=False)
+
+    def throttle(self):
+        """Sleep until an extra request may start, then mark it as started.
+
+        Extra requests keep ``min_interval`` (or the error backoff) from the
+        last request of any kind, but skip the idle stretch.
+        """
+        self._wait_for(extra=True)
+
+    def _wait_for(self, extra):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                gap = self.min_interval if extra and not self.errors else self.interval
+                due = now if self._last_start is None else self._last_start + gap
+                if due <= now:
+                    self._last_start = now
+                    return
+            time.sleep(due - now)
+
+    def record(self, new_records):
+        """Adjust the interval after a successful poll."""
+        self.errors = 0
+        if new_records > 0:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.idle_growth, self.max_interval)
+
+    def record_error(self):
+        """Back off exponentially after a failed poll."""
+        self.errors += 1
+        self.interval = min(max(self.interval, self.min_interval) * self.error_backoff,
+                            self.max_error_interval)
+
+    def status(self):
+        return f"Poll={self.interval:.2f}s Errors={self.errors}"
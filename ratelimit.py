@@ -0,0 +1,186 @@
+"""Token-bucket pacing for Telegram Bot API calls.
+
+The senders used fixed sleeps (0.5s per group message, 0.2s per DM, 0.02-0.05s
+in the DataTables workers and in broadcasts).  Those were too slow when the
+queue was quiet and too fast in a burst, and they only backed off after a 429
+had already arrived.  ``TelegramLimiter`` models the limits Telegram documents
+for a bot:
+
+* about 30 messages per second overall,
+* about 20 messages per minute in one group or channel,
+* about 1 message per second in one private chat.
+
+Every send / edit / delete first books the next slot in the target chat's
+bucket and sleeps until it, then does the same on the global bucket.  Chat
+slots may be booked well ahead (a busy group); the global token is only taken
+when the call is about to go out, so one slow group never holds back other
+chats.  Group and channel posts may not take the last ``dm_reserve`` global
+tokens, so a group backlog never delays personal DMs.  ``backoff`` applies a ``retry_after`` Telegram still returns, to that
+chat only.  ``limit_bot`` routes a TeleBot's own send/edit/delete methods
+through the limiter, so ``bot.send_message`` and ``bot.reply_to`` are paced
+as well.
+"""
+import threading
+import time
+
+GLOBAL_RATE, GLOBAL_BURST = 30.0, 30
+GROUP_RATE, GROUP_BURST = 20 / 60.0, 5
+PRIVATE_RATE, PRIVATE_BURST = 1.0, 2
+DM_RESERVE = 10  # Global tokens only private chats may spend
+
+
+class TokenBucket:
+    """Token bucket that books future slots instead of sleeping itself."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = time.monotonic() if now is None else now
+
+    def _level(self, now):
+        """(time, tokens) the bucket can next be evaluated at."""
+        base = max(now, self.stamp)
+        return base, min(self.capacity, self.tokens + max(0.0, now - self.stamp) * self.rate)
+
+    def available_at(self, now, reserve=0):
+        """When a token can be taken while leaving ``reserve`` in the bucket."""
+        base, tokens = self._level(now)
+        needed = 1 + reserve
+        return base if tokens >= needed else base + (needed - tokens) / self.rate
+
+    def take(self, at):
+        """Spend one token at time ``at`` (>= ``available_at``)."""
+        base, tokens = self._level(at)
+        self.tokens = tokens - 1
+        self.stamp = base
+
+    def block(self, until):
+        """Hold the next token back until ``until``."""
+        if until > self.stamp:
+            self.tokens = min(1.0, self.capacity)
+            self.stamp = until
+
+    def idle(self, now):
+        return self.stamp <= now and self._level(now)[1] >= self.capacity
+
+
+def is_private(chat_id):
+    """Private chats have positive ids; groups, supergroups and channels are negative or @names."""
+    try:
+        return int(chat_id) > 0
+    except (TypeError, ValueError):
+        return False
+
+
+class TelegramLimiter:
+    """Global plus per-chat token buckets for one bot token."""
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 group_rate=GROUP_RATE, group_burst=GROUP_BURST,
+                 private_rate=PRIVATE_RATE, private_burst=PRIVATE_BURST,
+                 dm_reserve=DM_RESERVE, prune_every=1000):
+        self._global = TokenBucket(global_rate, global_burst)
+        self._group = (group_rate, group_burst)
+        self._private = (private_rate, private_burst)
+        self.dm_reserve = min(dm_reserve, max(0, global_burst - 1))
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._prune_every = prune_every
+        self._calls = 0
+        self.waited = 0.0
+        self.backoffs = 0
+
+    def _bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate, burst = self._private if is_private(chat_id) else self._group
+            bucket = self._chats[chat_id] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _reserve(self, chat_id, reserve=0):
+        """Book the next slot in ``chat_id``'s bucket (the global one for None)."""
+        with self._lock:
+            now = time.monotonic()
+            if chat_id is None:
+                bucket = self._global
+            else:
+                self._calls += 1
+                if self._calls % self._prune_every == 0:
+                    self._prune(now)
+                bucket = self._bucket(chat_id, now)
+            at = bucket.available_at(now, reserve)
+            bucket.take(at)
+            self.waited += at - now
+            return at - now
+
+    def acquire(self, chat_id=None):
+        """Block until a call to ``chat_id`` is within every budget."""
+        if chat_id is not None:
+            wait = self._reserve(chat_id)
+            if wait > 0:
+                time.sleep(wait)
+        reserve = 0 if chat_id is None or is_private(chat_id) else self.dm_reserve
+        wait = self._reserve(None, reserve)
+        if wait > 0:
+            time.sleep(wait)
+
+    def backoff(self, chat_id, retry_after):
+        """Honour a 429 ``retry_after`` for one chat (or every chat when None)."""
+        with self._lock:
+            until = time.monotonic() + float(retry_after)
+            bucket = self._global if chat_id is None else self._bucket(chat_id, time.monotonic())
+            bucket.block(until)
+            self.backoffs += 1
+
+    def _prune(self, now):
+        for chat_id in [c for c, b in self._chats.items() if b.idle(now)]:
+            del self._chats[chat_id]
+
+    def status(self):
+        return f"Limiter: chats={len(self._chats)} waited={self.waited:.0f}s backoffs={self.backoffs}"
+
+
+def retry_after(error):
+    """``retry_after`` seconds of a TeleBot 429 exception, else None."""
+    if getattr(error, "error_code", None) != 429:
+        return None
+    result = getattr(error, "result_json", None) or {}
+    return (result.get("parameters") or {}).get("retry_after", 1)
+
+
+# Bot method -> position of chat_id among its positional arguments
+LIMITED_METHODS = {
+    "send_message": 0,
+    "delete_message": 0,
+    "edit_message_text": 1,
+}
+
+
+def limit_bot(bot, limiter, methods=LIMITED_METHODS):
+    """Route ``bot``'s send/edit/delete methods through ``limiter``.
+
+    Shadows the bound methods on the instance, so TeleBot's own helpers that
+    call ``self.send_message`` (``reply_to``) are paced too.  A 429 that still
+    gets through is applied to the chat and the call is retried once.
+    """
+    for name, chat_pos in methods.items():
+        method = getattr(bot, name)
+
+        def limited(*args, _method=method, _pos=chat_pos, **kwargs):
+            chat_id = kwargs.get("chat_id", args[_pos] if len(args) > _pos else None)
+            limiter.acquire(chat_id)
+            try:
+                return _method(*args, **kwargs)
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None:
+                    raise
+                limiter.backoff(chat_id, wait)
+                limiter.acquire(chat_id)
+                return _method(*args, **kwargs)
+
+        setattr(bot, name, limited)
+    return bot
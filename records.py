@@ -0,0 +1,120 @@
+"""Canonical identity of an OTP record.
+
+Each pipeline used to invent its own id: ``dt + num + message[:50]`` strings
+in the crapi bots, md5 hex in the DataTables bots, and ``hash()`` of the text
+plus ``time.time()`` for kontek's "View Full" buttons.  ``record_id`` is
+one stable 64-bit digest of the normalized number, timestamp and message.
+It fits an SQLite INTEGER key and a callback payload, and it is the same in
+every process and after a restart.
+
+``OtpRecord`` is a received SMS with its OTP, country and service resolved
+by ``build_record``, once, where the fetcher produces it.  Queues, stores
+and formatters read its fields instead of re-parsing the message.  It is a
+``__slots__`` class and the few distinct sender and country strings are
+interned, so a backlog of queued records holds no per-record dicts and no
+duplicate strings.  ``from_viewstats`` and ``from_datatables`` convert the
+two panel row shapes.
+"""
+import hashlib
+import sys
+
+from countries import country_table, resolver as country_resolver
+from otp import extract_otp
+from services import classifier as service_classifier
+
+
+def normalize_number(num):
+    """Number as stored in the lookup tables (no leading zeros or ``+``)."""
+    return str(num or "").lstrip("0").lstrip("+")
+
+
+def _digits(num):
+    return "".join(ch for ch in str(num or "") if ch.isdigit()).lstrip("0")
+
+
+def record_id(number, dt, message):
+    """Signed 64-bit id (SQLite INTEGER range) of one received SMS."""
+    key = "\x1f".join((_digits(number), str(dt or "").strip(), str(message or "").strip()))
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def record_hex(rid):
+    """Fixed-width 16-char text form, for TEXT columns and callback data."""
+    return format(rid & 0xFFFFFFFFFFFFFFFF, "016x")
+
+
+class OtpRecord:
+    """One received SMS, parsed."""
+
+    __slots__ = (
+        "id",             # record_id(number, dt, message)
+        "number",         # as the panel sent it
+        "normalized",     # normalize_number(number): lookup and storage key
+        "sender",
+        "message",
+        "dt",
+        "otp",
+        "country",
+        "iso2",
+        "flag",
+        "service_code",
+        "service_emoji",  # Telegram custom-emoji html
+    )
+
+    def __init__(self, id, number, normalized, sender, message, dt, otp,
+                 country, iso2, flag, service_code, service_emoji):
+        self.id = id
+        self.number = number
+        self.normalized = normalized
+        self.sender = sys.intern(sender)
+        self.message = message
+        self.dt = dt
+        self.otp = otp
+        self.country = sys.intern(country)
+        self.iso2 = iso2
+        self.flag = flag
+        self.service_code = service_code
+        self.service_emoji = service_emoji
+
+    @property
+    def hex_id(self):
+        return record_hex(self.id)
+
+    def __repr__(self):
+        return (f"OtpRecord({self.hex_id} {self.number!r} {self.sender!r} "
+                f"{self.iso2} otp={self.otp!r} dt={self.dt!r})")
+
+
+def build_record(number, sender, message, dt, country=None):
+    """Parse one SMS into an ``OtpRecord``.
+
+    ``country`` is the panel's country name where it sends one; otherwise the
+    country is resolved from the number's calling code.
+    """
+    number, message, dt = str(number or ""), str(message or ""), str(dt or "")
+    sender = str(sender or "") or "Unknown"
+    if country is None:
+        country, iso2, flag = country_resolver.resolve(number)
+    else:
+        meta = country_table.get(country)
+        iso2, flag = (meta.iso2, meta.flag) if meta else ("", "")
+    _, service_code, service_emoji = service_classifier.classify(sender)
+    return OtpRecord(
+        record_id(number, dt, message), number, normalize_number(number), sender, message, dt,
+        extract_otp(message), country, iso2 or country[:2].upper(), flag, service_code, service_emoji,
+    )
+
+
+def from_viewstats(row):
+    """``OtpRecord`` from one crapi ``viewstats`` row."""
+    return build_record(row.get("num"), row.get("cli"), row.get("message"), row.get("dt"))
+
+
+def from_datatables(row, message_col=5, country=None):
+    """``OtpRecord`` from one DataTables ``aaData`` row (dt, range, number, cli, ...).
+
+    Panels differ in where the SMS text sits (``message_col``) and in how the
+    country is derived, so the caller passes the country name it extracted.
+    """
+    return build_record(row[2], row[3], row[message_col], row[0], country=country)
@@ -0,0 +1,70 @@
+"""Sender (``cli``) -> service classification.
+
+Every bot kept its own ``SERVICE_CODES`` dict with each service spelled
+three ways, and ``get_service_code`` lowered both strings for every key
+until one matched.  kontek.py then ran a second chain of ``in`` checks for
+the emoji.  ``SERVICES`` is the one registry.  ``ServiceClassifier``
+compiles it into a single case-insensitive alternation and caches the
+answer per distinct sender, so each ``cli`` string is scanned once.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+Service = namedtuple("Service", "name code emoji emoji_id aliases")
+ServiceInfo = namedtuple("ServiceInfo", "name code emoji_html")
+
+# Registry order is match priority when a sender names two services
+SERVICES = (
+    Service("WhatsApp", "WA", "📱", "5334998226636390258", ()),
+    Service("Telegram", "TG", "✈️", "5330237710655306682", ()),
+    Service("Instagram", "IG", "📸", "5319160079465857105", ()),
+    Service("Facebook", "FB", "👤", "5323261730283863478", ()),
+    Service("Twitter", "TW", "", "", ()),
+    Service("Google", "GO", "", "", ()),
+    Service("Amazon", "AZ", "", "", ()),
+    Service("Snapchat", "SC", "", "", ()),
+    Service("TikTok", "TT", "", "", ("tik tok",)),
+    Service("LinkedIn", "LI", "", "", ("linked in",)),
+    Service("Uber", "UB", "", "", ()),
+    Service("PayPal", "PP", "", "", ()),
+)
+DEFAULT_EMOJI = ("🌐", "6125390694363175728")
+
+
+def emoji_html(emoji, emoji_id):
+    return f'<tg-emoji emoji-id="{emoji_id}">{emoji}</tg-emoji>'
+
+
+class ServiceClassifier:
+    """One-pass, memoized sender classifier over a service registry."""
+
+    def __init__(self, services=SERVICES, cache_size=4096):
+        self._priority = {}
+        for rank, service in enumerate(services):
+            for term in (service.name, *service.aliases):
+                self._priority.setdefault(term.lower(), (rank, service))
+        terms = sorted(self._priority, key=len, reverse=True)
+        self._pattern = re.compile("|".join(map(re.escape, terms)), re.I)
+        self._default_html = emoji_html(*DEFAULT_EMOJI)
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+
+    def _classify(self, sender):
+        """``ServiceInfo`` for ``sender``; unknown senders get their first two letters."""
+        sender = str(sender or "")
+        best = None
+        for match in self._pattern.finditer(sender):
+            hit = self._priority[match.group().lower()]
+            if best is None or hit[0] < best[0]:
+                best = hit
+        if best is None:
+            return ServiceInfo(sender, sender[:2].upper(), self._default_html)
+        service = best[1]
+        html = emoji_html(service.emoji, service.emoji_id) if service.emoji_id else self._default_html
+        return ServiceInfo(service.name, service.code, html)
+
+    def cache_info(self):
+        return self.classify.cache_info()
+
+
+classifier = ServiceClassifier()
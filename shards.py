@@ -0,0 +1,43 @@
+"""Keyed worker pool with per-key ordering.
+
+The crapi bots sent every DM from one ``personal_sender_thread``, so a
+burst for 200 users went out one at a time.  ``ShardedQueue`` keeps N plain
+FIFO queues, and a key (the chat_id) always hashes to the same one.  Each
+queue gets its own worker thread.  Messages for one chat are therefore
+delivered in order, by one worker, while different chats drain in
+parallel.  The shared ``TelegramLimiter`` still caps the total rate.
+``factory`` swaps the plain queues for anything with the same role, such
+as one ``Outbox`` lane per shard.  The shards' ``put`` signatures differ
+(``Queue.put(item)`` vs ``OutboxLane.put(chat_id, payload)``), so callers
+put through ``shard_for(key)`` rather than through this class.
+"""
+import threading
+from queue import Queue
+
+
+class ShardedQueue:
+    """Fixed set of FIFO queues; each key always lands on the same one."""
+
+    def __init__(self, shards=16, maxsize=0, factory=None):
+        if factory is None:
+            per_shard = -(-maxsize // shards) if maxsize > 0 else 0
+            self._queues = [Queue(maxsize=per_shard) for _ in range(shards)]
+        else:
+            self._queues = [factory(shard) for shard in range(shards)]
+
+    def __len__(self):
+        return len(self._queues)
+
+    def shard_for(self, key):
+        return self._queues[hash(key) % len(self._queues)]
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def depths(self):
+        return [q.qsize() for q in self._queues]
+
+    def start(self, worker, name):
+        """Run ``worker(queue)`` on its own daemon thread for every shard."""
+        for index, queue in enumerate(self._queues):
+            threading.Thread(target=worker, args=(queue,), daemon=True, name=f"{name}-{index}").start()
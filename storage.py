@@ -0,0 +1,219 @@
+"""Per-thread, long-lived SQLite connections.
+
+The bots used to open and close a connection for every helper call, paying
+for the open, the schema parse and a cold page cache each time, and the
+default rollback journal made readers and the writer block each other.
+``Database.connect()`` hands every thread its own connection, opened once in
+WAL mode with the pragmas below.  Compiled statements stay in the
+connection's statement cache, so repeated queries skip the prepare step.
+
+Callers keep the usual ``conn = db.connect() ... conn.close()`` shape:
+``close()`` on a pooled connection only rolls back an unfinished
+transaction and leaves the connection open for the thread's next call.
+The connection is really closed when its thread exits, so Flask's
+per-request threads do not leak a connection each.
+
+``WriteBehind`` takes the per-record INSERTs and counter upserts off the
+delivery path: a single writer thread commits them in batches.
+"""
+import atexit
+import queue
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # 16 MB page cache per connection
+    "PRAGMA mmap_size=134217728",    # 128 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose ``close()`` returns it to its thread."""
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def really_close(self):
+        super().close()
+
+
+class _ThreadConnection:
+    """Thread-local holder; dropped (and finalized) when its thread exits."""
+
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class Database:
+    """One WAL-mode connection per thread for a single database file."""
+
+    def __init__(self, path, row_factory=None, timeout=10, cached_statements=256):
+        self.path = path
+        self.row_factory = row_factory
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        holder = getattr(self._local, "holder", None)
+        conn = holder.conn if holder is not None else None
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                check_same_thread=False,
+                cached_statements=self.cached_statements,
+                factory=PooledConnection,
+            )
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            holder = self._local.holder = _ThreadConnection(conn)
+            with self._lock:
+                self._all.append(conn)
+            weakref.finalize(holder, self._release, conn)
+        elif conn.in_transaction:
+            # A previous caller on this thread raised before commit/close
+            conn.rollback()
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            if conn in self._all:
+                self._all.remove(conn)
+        try:
+            conn.really_close()
+        except sqlite3.Error:
+            pass
+
+    def open_connections(self):
+        with self._lock:
+            return len(self._all)
+
+    def close_all(self):
+        """Close every thread's connection (shutdown only)."""
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            try:
+                conn.really_close()
+            except sqlite3.Error:
+                pass
+
+
+class WriteBehind:
+    """Writer thread that commits queued statements in batches.
+
+    ``submit(sql, params)`` returns immediately.  The writer commits once
+    ``max_batch`` statements are waiting or ``max_delay`` seconds after the
+    oldest one arrived, whichever comes first.  Pending writes are flushed
+    at interpreter exit.  A batch that fails for any reason is logged and
+    counted, and the thread moves on to the next one; ``alive()`` tells
+    health checks whether it is still running.
+    """
+
+    def __init__(self, db, max_batch=200, max_delay=0.2, name="DBWriter"):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self.batches = 0
+        self.rows = 0
+        self.failed = 0
+        self.last_batch = 0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+            self._thread.start()
+            atexit.register(self.flush)
+        return self
+
+    def submit(self, sql, params=()):
+        self._queue.put((sql, params, time.monotonic()))
+
+    def flush(self):
+        """Block until everything submitted so far is committed."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._commit(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"❌ Dropped batch of {len(batch)} write(s): {e}", flush=True)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _commit(self, batch):
+        conn = self.db.connect()
+        try:
+            for sql, params, _ in batch:
+                conn.execute(sql, params)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"⚠️ Batch write failed ({e}), retrying row by row", flush=True)
+            for sql, params, _ in batch:
+                try:
+                    conn.execute(sql, params)
+                    conn.commit()
+                except Exception as row_error:
+                    conn.rollback()
+                    self.failed += 1
+                    print(f"❌ Dropped write: {row_error}", flush=True)
+
+        latency = time.monotonic() - batch[0][2]
+        self.batches += 1
+        self.rows += len(batch)
+        self.last_batch = len(batch)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def status(self):
+        avg = self.rows / self.batches if self.batches else 0
+        return (f"Writer: alive={'yes' if self.alive() else 'no'} pending={self._queue.qsize()} batches={self.batches} "
+                f"avg_batch={avg:.1f} last_latency={self.last_latency * 1000:.0f}ms "
+                f"max_latency={self.max_latency * 1000:.0f}ms failed={self.failed}")
+
+
+def exit_on_sigterm():
+    """Turn SIGTERM into a normal exit so atexit flushes still run."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
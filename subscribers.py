@@ -0,0 +1,86 @@
+"""In-memory number -> chat_ids index for personal OTP routing.
+
+Routing a scraped record used to cost a database query per record
+(``get_chat_by_number`` / ``SELECT DISTINCT chat_id FROM user_assignments``),
+and metrio.py's ``user_numbers`` dict was neither persisted nor pruned.
+``SubscriberIndex`` is loaded once from the assignments table and updated by
+the assignment helpers right after their database commit, so a lookup is a
+dict access.
+"""
+import threading
+
+from records import normalize_number
+
+_EMPTY = frozenset()
+
+
+class SubscriberIndex:
+    """Thread-safe two-way map between numbers and the chats watching them.
+
+    With ``exclusive`` a number belongs to one chat only, the one that was
+    given it last, so a number handed to a new user stops reaching the old one.
+    """
+
+    def __init__(self, exclusive=False):
+        self.exclusive = exclusive
+        self._chats_by_number = {}
+        self._numbers_by_chat = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._chats_by_number)
+
+    def load(self, rows):
+        """Rebuild from ``(number, chat_id)`` rows, oldest first (later rows win when exclusive)."""
+        chats_by_number, numbers_by_chat = {}, {}
+        for number, chat_id in rows:
+            key = normalize_number(number)
+            if self.exclusive:
+                for old_chat in chats_by_number.pop(key, ()):
+                    numbers_by_chat[old_chat].discard(key)
+                    if not numbers_by_chat[old_chat]:
+                        del numbers_by_chat[old_chat]
+            chats_by_number.setdefault(key, set()).add(chat_id)
+            numbers_by_chat.setdefault(chat_id, set()).add(key)
+        with self._lock:
+            self._chats_by_number = chats_by_number
+            self._numbers_by_chat = numbers_by_chat
+
+    def chats_for(self, number):
+        key = normalize_number(number)
+        with self._lock:
+            return frozenset(self._chats_by_number.get(key, _EMPTY))
+
+    def assign(self, number, chat_id):
+        """Give ``number`` to ``chat_id`` alone (user_numbers keeps one owner per number)."""
+        key = normalize_number(number)
+        with self._lock:
+            for old_chat in self._chats_by_number.get(key, ()):
+                self._discard(old_chat, key)
+            self._chats_by_number[key] = {chat_id}
+            self._numbers_by_chat.setdefault(chat_id, set()).add(key)
+
+    def replace_chat(self, chat_id, numbers):
+        """Make ``numbers`` the complete assignment list of ``chat_id``."""
+        keys = {normalize_number(n) for n in numbers}
+        with self._lock:
+            for key in self._numbers_by_chat.pop(chat_id, set()):
+                chats = self._chats_by_number.get(key)
+                if chats:
+                    chats.discard(chat_id)
+                    if not chats:
+                        del self._chats_by_number[key]
+            for key in keys:
+                if self.exclusive:
+                    for old_chat in self._chats_by_number.pop(key, ()):
+                        self._discard(old_chat, key)
+                self._chats_by_number.setdefault(key, set()).add(chat_id)
+            if keys:
+                self._numbers_by_chat[chat_id] = keys
+
+    def _discard(self, chat_id, key):
+        numbers = self._numbers_by_chat.get(chat_id)
+        if numbers:
+            numbers.discard(key)
+            if not numbers:
+                del self._numbers_by_chat[chat_id]
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import time
+import unittest
+
+from outbox import Outbox
+from storage import Database
+
+
+class OutboxOrderingTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(Database(os.path.join(self.dir.name, "outbox.db")), retry_delay=60)
+        self.lane = self.outbox.lane("dm0")
+
+    def tearDown(self):
+        self.outbox.db.close_all()
+        self.dir.cleanup()
+
+    def texts(self, items):
+        return [item.payload["text"] for item in items]
+
+    def test_retry_holds_back_later_rows_for_the_same_chat(self):
+        self.lane.put(1, {"text": "a1"})
+        self.lane.put(2, {"text": "b1"})
+        first = self.lane.claim(1, timeout=0)
+        self.assertEqual(self.texts(first), ["a1"])
+        self.lane.retry([first[0].id])
+
+        self.lane.put(1, {"text": "a2"})
+        # b1 is unaffected; a2 must wait behind the retried a1
+        self.assertEqual(self.texts(self.lane.claim(10, timeout=0)), ["b1"])
+        self.assertEqual(self.lane.claim(10, timeout=0), [])
+
+        self.lane.retry([first[0].id], delay=0)
+        time.sleep(0.01)
+        self.assertEqual(self.texts(self.lane.claim(10, timeout=0)), ["a1", "a2"])
+
+    def test_leased_row_holds_back_later_rows_for_the_same_chat(self):
+        self.lane.put(1, {"text": "a1"})
+        self.assertEqual(self.texts(self.lane.claim(1, timeout=0)), ["a1"])
+        self.lane.put(1, {"text": "a2"})
+        self.assertEqual(self.lane.claim(10, timeout=0), [])
+
+    def test_ack_releases_the_chat(self):
+        self.lane.put(1, {"text": "a1"})
+        self.lane.put(1, {"text": "a2"})
+        first = self.lane.claim(1, timeout=0)
+        self.lane.ack([first[0].id])
+        self.assertEqual(self.texts(self.lane.claim(10, timeout=0)), ["a2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
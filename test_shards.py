@@ -0,0 +1,41 @@
+import os
+import tempfile
+import time
+import unittest
+
+from outbox import Outbox
+from shards import ShardedQueue
+from storage import Database
+
+
+class OutboxShardTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(Database(os.path.join(self.dir.name, "outbox.db")))
+        self.queue = ShardedQueue(4, factory=lambda shard: self.outbox.lane(f"dm{shard}"))
+
+    def tearDown(self):
+        self.outbox.db.close_all()
+        self.dir.cleanup()
+
+    def test_put_through_shard_for_stores_chat_and_deadline(self):
+        deadline = time.time() + 600
+        self.queue.shard_for(42).put(42, {"text": "hi"}, deadline=deadline, fetch_time=1.0)
+        items = self.queue.shard_for(42).claim(10, timeout=0)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].chat_id, 42)
+        self.assertEqual(items[0].payload, {"text": "hi"})
+        self.assertEqual(items[0].deadline, deadline)
+        self.assertEqual(items[0].meta, {"fetch_time": 1.0})
+
+    def test_a_chat_always_lands_on_the_same_lane(self):
+        for text in ("a", "b", "c"):
+            self.queue.shard_for(7).put(7, {"text": text})
+        self.assertEqual(self.queue.qsize(), 3)
+        self.assertEqual(sorted(self.queue.depths()), [0, 0, 0, 3])
+        texts = [item.payload["text"] for item in self.queue.shard_for(7).claim(10, timeout=0)]
+        self.assertEqual(texts, ["a", "b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
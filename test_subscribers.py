@@ -0,0 +1,35 @@
+import unittest
+
+from subscribers import SubscriberIndex
+
+
+class ExclusiveSubscriberTest(unittest.TestCase):
+    def test_number_given_to_a_second_chat_only_reaches_that_chat(self):
+        index = SubscriberIndex(exclusive=True)
+        index.replace_chat(1, ["+15550001"])
+        index.replace_chat(2, ["15550001"])
+        self.assertEqual(index.chats_for("15550001"), {2})
+
+    def test_first_chat_keeps_its_new_number(self):
+        index = SubscriberIndex(exclusive=True)
+        index.replace_chat(1, ["15550001"])
+        index.replace_chat(2, ["15550001"])
+        index.replace_chat(1, ["15550002"])
+        self.assertEqual(index.chats_for("15550001"), {2})
+        self.assertEqual(index.chats_for("15550002"), {1})
+
+    def test_load_lets_the_newest_row_win(self):
+        index = SubscriberIndex(exclusive=True)
+        index.load([("15550001", 1), ("15550002", 1), ("15550001", 2)])
+        self.assertEqual(index.chats_for("15550001"), {2})
+        self.assertEqual(index.chats_for("15550002"), {1})
+
+    def test_shared_numbers_without_exclusive(self):
+        index = SubscriberIndex()
+        index.replace_chat(1, ["15550001"])
+        index.replace_chat(2, ["15550001"])
+        self.assertEqual(index.chats_for("15550001"), {1, 2})
+
+
+if __name__ == "__main__":
+    unittest.main()